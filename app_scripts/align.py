@@ -1,45 +1,43 @@
 from app_scripts.BLOSUM import get_matrix
-import itertools
+from app_scripts.sequ import mapped_rows
+import os, sys, json, hashlib
+import weakref # Used by ColumnProfile to refer to a tracked SeqList
 from math import sqrt
-from collections import Counter
+from collections import Counter, OrderedDict, deque, namedtuple
+from heapq import heappush, heappop, nlargest
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy as np
+except ImportError:
+    np = None # The pure-Python functions are used as fallbacks if numpy is unavailable
 
-# Implement a sliding window for the variation calculation.
-# Implement a threaded version of the variation function. Not sure if I want this module to implement a threaded version, or just provide a version of the function(s) that can be used by a thread pool managed in the user's other code.
+# The `workers` argument of consensus(), variants(), variation(), and identities() splits the columns or pairs into chunks computed in a process pool. Threads wouldn't help here because of the GIL.
 # Implement the quality function, even if i'm not using it for this
-# I think I might be able to vectorize the identity functions. Especially for all-against-all calculations.
-#  - ALREADY DONE! I basically did this in .../work/heme_slp_diversity/tom_abaumanii/calculate_alignment_identity.py and it is crazy fast (300 sequences, ~100k comparisons in ~1 sec)
-#    - Incorporate that into this file. Make sure it's working as intended. The method is slightly different from what i ahve below, likely better, but test. That one will be more memory-intensive; check if it gets too big with alignments >1000 or >4000 sequences. Maybe the per-column approach below will be fast enough and more efficient.
-#    - I like the various public methods defined there, use them. Keep the below functions as fallbacks in case numpy can't be imported
-#  - maintain 2 nxn matrices, 1 for non-gap matches, 1 for total comparisons. take sequences, go through column at a time. numpy to turn the column vector x its transpose into matrices, add to maintained matrices.
-#    - or maybe 1 matrix for matches, 1 for gap-gap matches; ident is then (matches-gaps) / (total_length-gaps). don't forget to remove the impact of self-self comparisons
-# - Could likely make use of triangular objects to store data. they'll get big for large alignments.
-# - Likely will need 1 function for 1x1 identity, 1 for 1xall, and 1 for allxall
+# The all-against-all identities are vectorized in identity_matrix(), using 1 matrix product per residue for the non-gap matches and 1 for the gap-gap columns; identity() and the loop in identities() are kept as fallbacks in case numpy can't be imported.
+#  - The full nxn matrix gets big for alignments >4000 sequences.
+# - identity() is 1x1, identity_to_all() is 1xall, and identity_matrix() is allxall.
 
-# variation() takes ~30 sec for lenient_old.aln; vectorize it.
+# variation() took ~30 sec for lenient_old.aln; now vectorized with numpy when available.
 
 # For convenience, import some of the major functions from sequ into this namespace. Like the load functions; don't want user to have to import sequ just for that.
 
 
-def consensus(seqs, allow_gaps=True):
-    """Expects seqs is a list of aligned sequences as strings/Sequences or a SeqList. At each position returns the most frequent character, the first encountered if there is a tie. If allow_gaps is False, returns the most frequent non-gap character, with arbitrary tie-breaking. Will only return a gap if the entire column is gaps."""
-    consensus = []
-    for column in zip(*seqs):
-        cntr = Counter(column)
-        if allow_gaps:
-            c = max(column, key=cntr.get)
-        else:
-            cs = cntr.most_common(2)
-            c = cs[1][0] if len(cs)>1 and cs[0][0]=='-' else cs[0][0]
-        consensus.append(c)
-    return ''.join(consensus)
-
-def variants(seqs, number=None):
-    """Returns a list, where each column in the alignment generates a sublist of the form: [(c1, count1), (c2, count2), ...]. Here, c1 is the most common character at with count1 occurances. Ties are broken arbitrarily. `number` indicates the maximum number of top hits to return; returns all if None."""
-    vnts = []
-    for column in zip(*seqs):
-        cntr = Counter(column)
-        vnts.append(cntr.most_common(number))
-    return vnts
+def consensus(seqs, allow_gaps=True, workers=None):
+    """Expects seqs is a list of aligned sequences as strings/Sequences, a SeqList, or a ColumnProfile. At each position returns the most frequent character, the first encountered if there is a tie. If allow_gaps is False, returns the most frequent non-gap character, with the same tie-breaking. Will only return a gap if the entire column is gaps. If `workers` is an int > 1, chunks of columns are computed in a pool of that many processes."""
+    if workers and workers > 1 and not isinstance(seqs, ColumnProfile):
+        return ''.join(_map_column_chunks(seqs, 'consensus', (allow_gaps,), workers))
+    return get_profile(seqs).consensus(allow_gaps)
+def variants(seqs, number=None, workers=None):
+    """Returns a list, where each column in the alignment generates a sublist of the form: [(c1, count1), (c2, count2), ...]. Here, c1 is the most common character at with count1 occurances. Ties are broken by the first character encountered. `number` indicates the maximum number of top hits to return; returns all if None. `seqs` can also be a ColumnProfile. If `workers` is an int > 1, chunks of columns are computed in a pool of that many processes."""
+    if workers and workers > 1 and not isinstance(seqs, ColumnProfile):
+        return [vnts for chunk in _map_column_chunks(seqs, 'variants', (number,), workers) for vnts in chunk]
+    return get_profile(seqs).variants(number)
+def get_profile(seqs):
+    """Returns `seqs` if it is already a ColumnProfile, otherwise builds one from it."""
+    if isinstance(seqs, ColumnProfile):
+        return seqs
+    return ColumnProfile(seqs)
 
 # # #  Alignment identity
 def identity(seq1, seq2):
@@ -54,43 +52,303 @@ def identity(seq1, seq2):
             matches += 1
         total += 1
     return matches / total * 100.0
-def identities(seqs1, seqs2=[], average=True):
-    """Normally both `seqs1` and `seqs2` should be containers (SeqList or list) of sequences (Sequence objects or strings); however each argument can also be a single sequence outside of a container. The sequences need to already be aligned. If `seqs2` is empty, will return all pairwise identities within `seqs1` (skipping self & redundant comparisons). Otherwise will calculate identities between each sequence in `seqs1` and each sequence in `seqs2`, without checking for self or redundant comparisons. If `average` is False will return a list of all raw identities, otherwise will return the average."""
-    idents = []
+def identities(seqs1, seqs2=[], average=True, workers=None):
+    """Normally both `seqs1` and `seqs2` should be containers (SeqList or list) of sequences (Sequence objects or strings); however each argument can also be a single sequence outside of a container. The sequences need to already be aligned. If `seqs2` is empty, will return all pairwise identities within `seqs1` (skipping self & redundant comparisons). Otherwise will calculate identities between each sequence in `seqs1` and each sequence in `seqs2`, without checking for self or redundant comparisons. If `average` is False will return a list of all raw identities, otherwise will return the average. If `workers` is an int > 1, blocks of pairs are computed in a pool of that many processes."""
     if seqs2:
         if len(seqs1[0]) == 1: # if seqs1 is a single sequence instead of a container of sequences
             seqs1 = [seqs1]
         if len(seqs2[0]) == 1: # if seqs2 is a single sequence instead of a container of sequences
             seqs2 = [seqs2]
-        for seq1, seq2 in itertools.product(seqs1, seqs2):
-            idents.append(identity(seq1, seq2))
     elif len(seqs1[0]) != 1 and len(seqs1) > 1:
-        for seq1, seq2 in itertools.combinations(seqs1, 2):
-            idents.append(identity(seq1, seq2))
+        seqs2 = None
     else:
         raise ValueError("if only one group of sequences is given, it must contain more than 1 sequence to calculate percent identity.")
+    if workers and workers > 1:
+        pool_data = ([getattr(seq, 'seq', seq) for seq in seqs1], None if seqs2 is None else [getattr(seq, 'seq', seq) for seq in seqs2])
+        row_ranges = pair_chunks(len(seqs1), None if seqs2 is None else len(seqs2), workers*4)
+        idents = [ident for chunk in _run_in_pool(_identities_task, row_ranges, pool_data, workers) for ident in chunk]
+    else:
+        idents = identity_rows(seqs1, seqs2)
     if average:
         return sum(idents) / len(idents)
     else:
         return idents
+def identity_rows(seqs1, seqs2=None, start=0, end=None):
+    """Returns the identities for the sequences `seqs1[start:end]`, in the order used by identities(): against each later sequence in `seqs1` if `seqs2` is None, otherwise against each sequence in `seqs2`. Uses identities_numpy() if numpy is available, and identity() otherwise."""
+    if np is not None:
+        return identities_numpy(seqs1, seqs2, start, end)
+    end = len(seqs1) if end is None else min(end, len(seqs1))
+    if seqs2 is None:
+        return [identity(seqs1[i], seqs1[j]) for i in range(start, end) for j in range(i+1, len(seqs1))]
+    return [identity(seq1, seq2) for seq1 in seqs1[start:end] for seq2 in seqs2]
+def identities_numpy(seqs1, seqs2=None, start=0, end=None):
+    """Vectorized equivalent of the identity() loops in identities(), returning a list of identities in the same order as itertools.combinations(seqs1, 2), or itertools.product(seqs1, seqs2) if `seqs2` is given. If `start` or `end` are given, only pairs where the first sequence is in seqs1[start:end] are computed. Like identity(), raises a ZeroDivisionError if any pair of sequences are both entirely gaps."""
+    enc1 = encode_alignment(seqs1)
+    rows = enc1[start:end]
+    if seqs2 is None:
+        cols = rows if start+len(rows) == len(enc1) else enc1[start:] # Reusing `rows` lets pair_counts() skip recomputing the indicators
+        matches, totals = pair_counts(rows, cols)
+        inds = np.triu_indices(len(rows), 1, len(cols))
+        matches, totals = matches[inds], totals[inds]
+    else:
+        enc2 = encode_alignment(seqs2)
+        if enc1.shape[1] != enc2.shape[1]:
+            raise MolecbioAlignmentLengthError("cannot compute the identity between two sequences of different lengths. They should be aligned before calling the identities() function.")
+        matches, totals = pair_counts(rows, enc2)
+    if not totals.all():
+        raise ZeroDivisionError("cannot compute the identity between two sequences that are both entirely gaps.")
+    return (matches.ravel() / totals.ravel() * 100.0).tolist()
+def identity_to_all(query, seqs, top_k=None):
+    """Computes the identity (following identity()) of `query` to every sequence in `seqs` in one vectorized pass if numpy is available. `query` can be a Sequence or a string, and `seqs` a SeqList or list of sequences all aligned to it. If `top_k` is None returns a list of the identities in the order of `seqs`, where a pair that is entirely gaps has an identity of nan. Otherwise returns a list of the `top_k` most similar as (sequence, identity) tuples sorted from most to least similar, found with a partial sort; if `query` is a Sequence object in `seqs`, it is not included in those hits."""
+    query_str = getattr(query, 'seq', query)
+    if np is not None:
+        enc = encode_alignment(seqs)
+        query_enc = encode_alignment([query_str])[0]
+        if len(query_enc) != enc.shape[1]:
+            raise MolecbioAlignmentLengthError("cannot compute the identity between two sequences of different lengths. They should be aligned before calling the identity_to_all() function.")
+        gap = ord('-')
+        query_gaps = query_enc == gap
+        matches = np.count_nonzero((enc == query_enc) & ~query_gaps, axis=1)
+        totals = len(query_enc) - np.count_nonzero(enc[:, query_gaps] == gap, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            idents = matches / totals * 100.0
+        if top_k is None:
+            return idents.tolist()
+        scores = np.where(np.isnan(idents), -1.0, idents)
+        self_inds = [ind for ind, seq in enumerate(seqs) if seq is query]
+        scores[self_inds] = -2.0 # Sorted below everything else
+        num_hits = min(top_k, len(scores) - len(self_inds))
+        if num_hits <= 0:
+            return []
+        top_inds = np.argpartition(-scores, num_hits-1)[:num_hits]
+        top_inds = sorted(top_inds.tolist(), key=lambda ind: -scores[ind])
+        return [(seqs[ind], float(idents[ind])) for ind in top_inds]
+    idents = []
+    for seq in seqs:
+        try:
+            idents.append(identity(query_str, seq))
+        except ZeroDivisionError:
+            idents.append(float('nan'))
+    if top_k is None:
+        return idents
+    hits = ((ind, ident) for ind, ident in enumerate(idents) if seqs[ind] is not query)
+    top_hits = nlargest(top_k, hits, key=lambda hit: -1.0 if hit[1] != hit[1] else hit[1]) # nan sorted last
+    return [(seqs[ind], ident) for ind, ident in top_hits]
+def identity_clusters(seqs, threshold):
+    """Greedy, CD-HIT-style clustering of the aligned `seqs` by identity (following identity()). Sequences are visited from longest to shortest (by number of non-gap characters); each joins the existing representative it is most identical to if that identity is >= `threshold` percent, otherwise it becomes a new representative. Before any identities are computed, representatives are rejected if they cannot reach the threshold: the matches can be at most the residue composition shared by the pair, and the compared columns at least the longer of the 2 non-gap lengths. Returns a list of the representative indices in their original order, and a list giving the index of the representative for every sequence."""
+    if np is not None:
+        return _identity_clusters_numpy(seqs, threshold)
+    seq_strs = [getattr(seq, 'seq', seq) for seq in seqs]
+    if len({len(seq) for seq in seq_strs}) > 1:
+        raise MolecbioAlignmentLengthError("cannot cluster sequences of different lengths. They should be aligned first.")
+    comps = [Counter(seq) for seq in seq_strs]
+    for comp in comps:
+        comp.pop('-', None)
+    lengths = [sum(comp.values()) for comp in comps]
+    assignments = [None] * len(seq_strs)
+    reps, neg_rep_lens = [], [] # Reps are added in order of decreasing length, so `neg_rep_lens` is sorted
+    for ind in sorted(range(len(seq_strs)), key=lambda ind: -lengths[ind]):
+        cand_len, cand_comp = lengths[ind], comps[ind]
+        max_rep_len = cand_len * 100.0 / threshold if threshold > 0 else float('inf')
+        best_rep, best_ident = None, None
+        for rep in reps[bisect_left(neg_rep_lens, -max_rep_len):]:
+            max_len = max(lengths[rep], cand_len)
+            shared = sum(min(count, comps[rep][c]) for c, count in cand_comp.items())
+            if max_len and shared * 100.0 / max_len < threshold:
+                continue
+            ident = identity(seq_strs[ind], seq_strs[rep]) if max_len else 100.0 # Both entirely gaps
+            if ident >= threshold and (best_ident is None or ident > best_ident):
+                best_rep, best_ident = rep, ident
+        if best_rep is None:
+            reps.append(ind)
+            neg_rep_lens.append(-cand_len)
+            best_rep = ind
+        assignments[ind] = best_rep
+    return sorted(reps), assignments
+def _identity_clusters_numpy(seqs, threshold):
+    enc = encode_alignment(seqs)
+    num_seqs, aln_len = enc.shape
+    gap = ord('-')
+    chars = [c for c in np.flatnonzero(np.bincount(enc.ravel(), minlength=256)).tolist() if c != gap]
+    comps = np.zeros((num_seqs, len(chars)), dtype=np.int64)
+    for col, c in enumerate(chars):
+        comps[:, col] = np.count_nonzero(enc == c, axis=1)
+    lengths = comps.sum(axis=1)
+    assignments = np.empty(num_seqs, dtype=np.intp)
+    # Representative data are stored contiguously in the order they were added, which is by decreasing length
+    rep_inds = np.empty(num_seqs, dtype=np.intp)
+    rep_enc = np.empty((num_seqs, aln_len), dtype=np.uint8)
+    rep_comps = np.empty_like(comps)
+    neg_rep_lens = np.empty(num_seqs, dtype=np.int64)
+    num_reps = 0
+    for ind in np.argsort(-lengths, kind='stable').tolist():
+        cand_len = lengths[ind]
+        max_rep_len = cand_len * 100.0 / threshold if threshold > 0 else np.inf
+        first = np.searchsorted(neg_rep_lens[:num_reps], -max_rep_len) # Reps before this are too long
+        best_rep = None
+        if first < num_reps:
+            max_lens = np.maximum(-neg_rep_lens[first:num_reps], cand_len)
+            shared = np.minimum(rep_comps[first:num_reps], comps[ind]).sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                possible = np.flatnonzero((shared * 100.0 / max_lens >= threshold) | (max_lens == 0)) + first
+            if len(possible):
+                query = enc[ind]
+                query_gaps = query == gap
+                cands = rep_enc[possible]
+                matches = np.count_nonzero((cands == query) & ~query_gaps, axis=1)
+                totals = aln_len - np.count_nonzero(cands[:, query_gaps] == gap, axis=1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    idents = np.where(totals > 0, matches / totals * 100.0, 100.0) # Both entirely gaps
+                best = int(np.argmax(idents))
+                if idents[best] >= threshold:
+                    best_rep = rep_inds[possible[best]]
+        if best_rep is None:
+            rep_inds[num_reps], rep_enc[num_reps], rep_comps[num_reps], neg_rep_lens[num_reps] = ind, enc[ind], comps[ind], -cand_len
+            num_reps += 1
+            best_rep = ind
+        assignments[ind] = best_rep
+    return sorted(rep_inds[:num_reps].tolist()), assignments.tolist()
+def identity_matrix(seqs):
+    """Requires numpy. Computes all pairwise identities within the aligned `seqs` following the rules of identity(), returned as a condensed (upper triangular) float32 array in the order of itertools.combinations(seqs, 2). Use condensed_index() to find a given pair. Pairs of sequences that are both entirely gaps have an identity of nan."""
+    enc = encode_alignment(seqs)
+    matches, totals = pair_counts(enc, enc)
+    inds = np.triu_indices(len(enc), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        idents = matches[inds] / totals[inds] * 100.0
+    return idents.astype(np.float32)
+def condensed_index(num_seqs, i, j):
+    """Returns the index of the pair of sequences `i` and `j` in the condensed array of length num_seqs*(num_seqs-1)/2 returned by identity_matrix()."""
+    if i == j:
+        raise ValueError("the condensed identity matrix does not hold self comparisons.")
+    if i > j:
+        i, j = j, i
+    return num_seqs*i - i*(i+1)//2 + j - i - 1
+def identity_matrix_tiled(seqs, filename, tile_size=None, memory_budget=512*2**20, resume=True):
+    """Requires numpy. For alignments too large for identity_matrix(), computes the full square matrix of pairwise identities (following identity(); the diagonal is included) one block of `tile_size` rows x `tile_size` columns at a time, writing each finished tile and its mirror into a float32 .npy file at `filename`. If `tile_size` is None it is picked to keep the working memory of each tile under `memory_budget` bytes. Progress is recorded in '<filename>.progress' as the number of tiles finished, in the row-major order they are computed; if `resume` is True and that file matches the alignment and tile size, those tiles are skipped, so an interrupted run can be restarted with the same call. Returns the matrix as a read-only numpy memmap."""
+    enc = encode_alignment(seqs)
+    num_seqs, aln_len = enc.shape
+    if tile_size is None:
+        tile_size = identity_tile_size(aln_len, memory_budget)
+    tile_size = max(1, min(tile_size, num_seqs))
+    progress_path = filename + '.progress'
+    checksum = hashlib.blake2b(enc.tobytes(), digest_size=16).hexdigest()
+    progress = None
+    if resume and os.path.isfile(progress_path) and os.path.isfile(filename):
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress.get('checksum') != checksum or progress.get('tile_size') != tile_size or not isinstance(progress.get('tiles_done'), int):
+            progress = None
+    if progress is None:
+        progress = {'checksum':checksum, 'tile_size':tile_size, 'num_seqs':num_seqs, 'tiles_done':0}
+        idents = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(num_seqs, num_seqs))
+    else:
+        idents = np.lib.format.open_memmap(filename, mode='r+')
+    for row_start, col_start, tile in _iter_identity_tiles(enc, tile_size, start=progress['tiles_done']):
+        row_end, col_end = row_start + tile.shape[0], col_start + tile.shape[1]
+        idents[row_start:row_end, col_start:col_end] = tile
+        idents[col_start:col_end, row_start:row_end] = tile.T
+        idents.flush()
+        progress['tiles_done'] += 1
+        _write_json_atomic(progress, progress_path)
+    del idents
+    return np.load(filename, mmap_mode='r')
+def iter_identity_pairs(seqs, threshold, tile_size=None, memory_budget=512*2**20):
+    """Requires numpy. A generator yielding (i, j, identity) for each pair of sequences in `seqs` with i < j and an identity (following identity()) of at least `threshold` percent. Computed tile by tile as in identity_matrix_tiled() without ever holding the full matrix; pairs are yielded in tile order, not sorted."""
+    enc = encode_alignment(seqs)
+    if tile_size is None:
+        tile_size = identity_tile_size(enc.shape[1], memory_budget)
+    tile_size = max(1, tile_size)
+    for row_start, col_start, tile in _iter_identity_tiles(enc, tile_size):
+        with np.errstate(invalid='ignore'):
+            hits = tile >= threshold
+        if row_start == col_start:
+            hits = np.triu(hits, 1)
+        for i, j in zip(*np.nonzero(hits)):
+            yield row_start + int(i), col_start + int(j), float(tile[i, j])
+def identity_tile_size(aln_len, memory_budget):
+    """Returns the largest tile size (a multiple of 64, minimum 64) for which the estimated working memory of one tile computed by pair_counts() fits within `memory_budget` bytes: the float32 character indicators for the row and column blocks plus ~5 float64 tile-sized arrays."""
+    tile_size = 64
+    while 2*(tile_size+64)*aln_len*4 + 5*(tile_size+64)**2*8 <= memory_budget:
+        tile_size += 64
+    return tile_size
+def _iter_identity_tiles(enc, tile_size, start=0):
+    """Yields (row_start, col_start, tile) for each tile on or above the diagonal of the identity matrix of the encoded alignment `enc`, in row-major order, where `tile` is a float32 array of identities with nan for pairs of all-gap sequences. The first `start` tiles are not computed."""
+    num_seqs = len(enc)
+    tile_ind = 0
+    for row_start in range(0, num_seqs, tile_size):
+        rows = enc[row_start:row_start+tile_size]
+        for col_start in range(row_start, num_seqs, tile_size):
+            tile_ind += 1
+            if tile_ind <= start:
+                continue
+            cols = rows if col_start == row_start else enc[col_start:col_start+tile_size]
+            matches, totals = pair_counts(rows, cols)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                tile = (matches / totals * 100.0).astype(np.float32)
+            yield row_start, col_start, tile
+def _write_json_atomic(data, filename):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_filename, filename)
+def pair_counts(enc1, enc2):
+    """Requires numpy. `enc1` and `enc2` are encoded alignments from encode_alignment(), with the same number of columns. Returns 2 float64 arrays of shape (len(enc1), len(enc2)): the number of columns where each pair of sequences have the same non-gap character, and the number of columns that are not gaps in both sequences. Each is computed with bulk matrix products, 1 per character."""
+    gap = ord('-')
+    aln_len = enc1.shape[1]
+    gaps1 = (enc1 == gap).astype(np.float32)
+    gaps2 = gaps1 if enc2 is enc1 else (enc2 == gap).astype(np.float32)
+    totals = aln_len - (gaps1 @ gaps2.T).astype(np.float64)
+    del gaps1, gaps2
+    chars1 = np.flatnonzero(np.bincount(enc1.ravel(), minlength=256))
+    chars2 = chars1 if enc2 is enc1 else np.flatnonzero(np.bincount(enc2.ravel(), minlength=256))
+    matches = np.zeros((len(enc1), len(enc2)), dtype=np.float32) # Counts are exact up to 2^24 columns
+    for char in np.intersect1d(chars1, chars2):
+        if char == gap:
+            continue
+        is_char1 = (enc1 == char).astype(np.float32)
+        is_char2 = is_char1 if enc2 is enc1 else (enc2 == char).astype(np.float32)
+        matches += is_char1 @ is_char2.T
+    return matches.astype(np.float64), totals
 
 
 # # #  Alignment variation
-def variation(seqs, matrix='BLOSUM62', stdev=False):
+def variation(seqs, matrix='BLOSUM62', stdev=False, window=None, aggregate='mean', workers=None):
     """
     An adaptation of the quality calculation originally described in ClustalX (http://www.clustal.org/download/clustalx_help.html), implemented as x(). The default uses absolute mean deviation instead of standard deviation, which is more robust to outliers plus the interpretation does not depend on the scaling factors used in the particular BLOSUM matrix used (doubling the values will change stdev, but not absmeandev; TEST THAT).
-    The `matrix` argument allows other scoring matrices to be used. Must be one of: 'BLOSUM30', 'BLOSUM45', 'BLOSUM50', 'BLOSUM62', 'BLOSUM80', '30', '45', '50', '62', or '80'."""
-    blosum = get_matrix(matrix)
-
-    dev_fxn = column_std_deviation if stdev else column_absmean_deviation
-    num_seqs = len(seqs)
-    devs = []
-    for col in zip(*seqs):
-        # try some normalization, don't think i really want it though
-        #dev = (dev_fxn(col, blosum) - bl_min) / bl_range
-        dev = dev_fxn(col, blosum)
-        devs.append(dev)
+    The `matrix` argument allows other scoring matrices to be used. Must be one of: 'BLOSUM30', 'BLOSUM45', 'BLOSUM50', 'BLOSUM62', 'BLOSUM80', '30', '45', '50', '62', or '80'.
+    `seqs` can also be a ColumnProfile, in which case the sequences are not revisited.
+    If `window` is an int > 1, the scores are smoothed with sliding_window() using the given `aggregate`.
+    If `workers` is an int > 1, chunks of columns are computed in a pool of that many processes."""
+    if workers and workers > 1 and not isinstance(seqs, ColumnProfile):
+        devs = [dev for chunk in _map_column_chunks(seqs, 'variation', (matrix, stdev), workers) for dev in chunk]
+    else:
+        devs = get_profile(seqs).variation(matrix, stdev)
+    if window and window > 1:
+        devs = sliding_window(devs, window, aggregate)
     return devs
+def sliding_window(values, window, aggregate='mean'):
+    """Returns a list the same length as `values`, where each value is the `aggregate` ('mean', 'max', or 'median') of the `window` values centred on it. Windows are truncated at the ends. Computed with rolling accumulators, so the cost is O(n) for 'mean' and 'max' and O(n log window) for 'median'."""
+    aggregate = aggregate.lower()
+    if aggregate == 'mean':
+        accumulator = _RollingMean(values)
+    elif aggregate == 'max':
+        accumulator = _RollingMax(values)
+    elif aggregate == 'median':
+        accumulator = _RollingMedian(values)
+    else:
+        raise ValueError("unrecognized `aggregate` argument '{}'. It must be one of: 'mean', 'max', or 'median'.".format(aggregate))
+    num_vals, half = len(values), window // 2
+    smoothed, start_ind, end_ind = [], 0, 0
+    for ind in range(num_vals):
+        new_start, new_end = max(0, ind-half), min(num_vals, ind-half+window)
+        while end_ind < new_end:
+            accumulator.add(end_ind)
+            end_ind += 1
+        while start_ind < new_start:
+            accumulator.remove(start_ind)
+            start_ind += 1
+        smoothed.append(accumulator.value())
+    return smoothed
 def column_absmean_deviation(column, blosum):
     if len(set(column)) == 1:
         return 0.0
@@ -107,6 +365,542 @@ def column_dists_and_mean(column, blosum):
     mean_vec = [sum(dim_vec)/len(col_vecs) for dim_vec in zip(*col_vecs)]
     dists = [sqrt(sum((dim-mean)**2 for dim in dim_vec)) for dim_vec, mean in zip(zip(*col_vecs), mean_vec)]
     return dists, mean_vec
+def composition_deviation(composition, blosum, stdev=False):
+    """Equivalent to column_absmean_deviation(), or column_std_deviation() if `stdev` is True, for a column described by its `composition`: a list of (character, count) tuples."""
+    if len(composition) <= 1:
+        return 0.0
+    vecs = [blosum[c] for c, _ in composition]
+    total = sum(count for _, count in composition)
+    dists = []
+    for dim_vals in zip(*vecs):
+        mean = sum(val*count for val, (_, count) in zip(dim_vals, composition)) / total
+        dists.append(sqrt(sum((val-mean)**2 * count for val, (_, count) in zip(dim_vals, composition))))
+    if stdev:
+        return sqrt(sum(d*d for d in dists) / len(dists))
+    return sum(dists) / len(dists)
+
+
+# # #  Process pool execution
+def column_chunks(length, num_chunks):
+    """Returns a list of up to `num_chunks` (start, end) ranges of similar size covering range(length)."""
+    num_chunks = max(1, min(num_chunks, length))
+    bounds = [length * ind // num_chunks for ind in range(num_chunks+1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+def pair_chunks(num_seqs1, num_seqs2=None, num_chunks=1):
+    """Returns a list of (start, end) ranges of the first sequence of each pair, for use with identity_rows(). If `num_seqs2` is None the pairs are the triangle of all-against-all comparisons, so the ranges are chosen to hold similar numbers of pairs rather than of rows."""
+    if num_seqs2 is not None:
+        return column_chunks(num_seqs1, num_chunks)
+    total_pairs = num_seqs1 * (num_seqs1 - 1) // 2
+    target = max(1, total_pairs // max(1, num_chunks))
+    ranges, start, num_pairs = [], 0, 0
+    for ind in range(num_seqs1):
+        num_pairs += num_seqs1 - ind - 1
+        if num_pairs >= target:
+            ranges.append((start, ind+1))
+            start, num_pairs = ind+1, 0
+    if start < num_seqs1:
+        ranges.append((start, num_seqs1))
+    return ranges
+def _map_column_chunks(seqs, method, method_args, workers):
+    """Computes ColumnProfile.`method`(*method_args) for chunks of columns in a process pool, returning the results in column order."""
+    seq_strs = [getattr(seq, 'seq', seq) for seq in seqs]
+    aln_len = max((len(seq) for seq in seq_strs), default=0)
+    tasks = [(start, end, method, method_args) for start, end in column_chunks(aln_len, workers*4)]
+    return _run_in_pool(_profile_task, tasks, seq_strs, workers)
+def _run_in_pool(task, task_args, pool_data, workers):
+    # `pool_data` is sent to each worker process once, instead of with every task.
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_pool_worker, initargs=(pool_data,)) as pool:
+        return list(pool.map(task, task_args))
+_pool_data = None # Set in each worker process by _init_pool_worker()
+def _init_pool_worker(pool_data):
+    global _pool_data
+    _pool_data = pool_data
+def _profile_task(args):
+    start, end, method, method_args = args
+    profile = ColumnProfile([seq[start:end] for seq in _pool_data])
+    return getattr(profile, method)(*method_args)
+def _identities_task(args):
+    start, end = args
+    seqs1, seqs2 = _pool_data
+    return identity_rows(seqs1, seqs2, start, end)
+
+
+# # #  Module constants
+# Amino acid groups used by Clustal for the conservation line
+clustal_strong_groups = (set('STA'), set('NEQK'), set('NHQK'), set('NDEQ'), set('QHRK'),
+                         set('MILV'), set('MILF'), set('HY'), set('FYW'))
+clustal_weak_groups = (set('CSA'), set('ATV'), set('SAG'), set('STNK'), set('STPA'),
+                       set('SGND'), set('SNDEQK'), set('NDEQHK'), set('NEQHRK'),
+                       set('FVLIM'), set('HFY'))
+
+
+# # #  Numpy encoding
+def encode_alignment(seqs):
+    """Requires numpy. Returns a read-only uint8 array of shape (number of sequences, alignment length) holding the ASCII code of each character in `seqs`, which can be a SeqList or a list of Sequences/strings. Non-ASCII characters are encoded as '?'. An AlignmentMatrix, or sequences from a memory-mapped alignment (see sequ.load_mapped()), are read straight from their buffer without building any strings; a whole matrix or all of the mapped rows in order give a view of the buffer itself."""
+    mapped = mapped_rows(seqs)
+    if mapped is not None:
+        mapping, rows = mapped
+        enc = np.frombuffer(mapping.residues, dtype=np.uint8).reshape(mapping.num_seqs, mapping.aln_len)
+        if rows != list(range(mapping.num_seqs)):
+            enc = enc[rows]
+            enc.flags.writeable = False
+        return enc
+    seq_strs = [getattr(seq, 'seq', seq) for seq in seqs]
+    aln_len = len(seq_strs[0]) if seq_strs else 0
+    if any(len(seq) != aln_len for seq in seq_strs):
+        raise MolecbioAlignmentLengthError("cannot encode sequences of different lengths. They should be aligned first.")
+    buff = ''.join(seq_strs).encode('ascii', 'replace')
+    return np.frombuffer(buff, dtype=np.uint8).reshape(len(seq_strs), aln_len)
+def column_byte_counts(enc, block_size=2**20):
+    """Requires numpy. Returns the byte values present in the encoded alignment `enc` as a sorted array of length k, and 2 int64 arrays of shape (alignment length, k): the occurrences of each of those byte values in every column, and the row at which each was first seen in that column (the number of sequences if it was never seen). Counting over only the bytes present, in blocks of whole rows holding about `block_size` characters, keeps the scratch memory proportional to the block plus alignment length x k."""
+    num_seqs, aln_len = enc.shape
+    rows_per_block = max(1, block_size // max(aln_len, 1))
+    byte_counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, num_seqs, rows_per_block):
+        byte_counts += np.bincount(enc[start:start+rows_per_block].ravel(), minlength=256)
+    present = np.flatnonzero(byte_counts)
+    num_chars = len(present)
+    lookup = np.zeros(256, dtype=np.intp)
+    lookup[present] = np.arange(num_chars)
+    offsets = np.arange(aln_len, dtype=np.intp) * num_chars
+    counts = np.zeros(aln_len*num_chars, dtype=np.int64)
+    first_rows = np.full(aln_len*num_chars, num_seqs, dtype=np.int64)
+    block_rows = np.empty(aln_len*num_chars, dtype=np.int64)
+    for start in range(0, num_seqs, rows_per_block):
+        block = enc[start:start+rows_per_block]
+        keys = lookup[block]
+        keys += offsets
+        keys = keys.ravel()
+        counts += np.bincount(keys, minlength=aln_len*num_chars)
+        rows = np.repeat(np.arange(start, start+len(block), dtype=np.int64), aln_len)
+        block_rows.fill(num_seqs)
+        block_rows[keys[::-1]] = rows[::-1] # With repeated indices the last assignment wins, so this keeps the earliest row
+        np.minimum(first_rows, block_rows, out=first_rows)
+    return present, counts.reshape(aln_len, num_chars), first_rows.reshape(aln_len, num_chars)
+
+
+# # #  Module classes
+class ColumnProfile():
+    """
+    The per-column character counts of an alignment, built in a single pass over the sequences. The consensus, variants, variation scores and Clustal conservation line are all derived from the counts without revisiting the sequences. Uses numpy arrays if available, otherwise lists of lists.
+    If `track` is True, `seqs` must be a SeqList; the profile then follows its membership changes, adding or subtracting the contribution of each appended or removed sequence in O(alignment length). Ties are still broken by the order of the SeqList, as in a freshly built profile; after a removal or an insertion other than at the end, that order is recomputed from the SeqList the next time the variants or consensus are requested. Edits to the sequences of existing members are not followed."""
+    def __init__(self, seqs, track=False):
+        # #  Public attributes
+        self.alphabet = [] # The characters present in the alignment; the columns of `counts`.
+        self.counts = [] # Count matrix of shape (alignment length, len(alphabet)).
+        self.num_seqs = len(seqs)
+        self.length = 0
+        # #  Private attributes
+        self.first_seen = [] # Same shape as `counts`; lower values were encountered first in that column. Used to break ties.
+        self.next_order = 0 # The `first_seen` value given to characters newly added to a column.
+        self.order_stale = False # True if `first_seen` no longer follows the order of the tracked SeqList.
+        self.alpha_inds = {} # Maps each character in `alphabet` to its index.
+        self.variation_sums = {} # Per-column sums of the BLOSUM vectors and of their squares, keyed by BLOSUM name.
+        self.tracked_ref = None # weakref to the tracked SeqList
+        # #  Finish initialization
+        if np is not None:
+            self._build_numpy(seqs)
+        else:
+            self._build_python(seqs)
+        self.alpha_inds = {c:ind for ind, c in enumerate(self.alphabet)}
+        self.next_order = self.num_seqs
+        if track:
+            self.tracked_ref = weakref.ref(seqs)
+            seqs.trackers.append(self)
+
+    # #  Derived values
+    def consensus(self, allow_gaps=True):
+        """See the consensus() function."""
+        consensus = []
+        for ranked in self.variants(2):
+            c = ranked[0][0]
+            if not allow_gaps and c == '-' and len(ranked) > 1:
+                c = ranked[1][0]
+            consensus.append(c)
+        return ''.join(consensus)
+    def variants(self, number=None):
+        """See the variants() function."""
+        vnts = []
+        if self.order_stale:
+            self._refresh_first_seen()
+        if np is not None:
+            orders = np.lexsort((self.first_seen, -self.counts), axis=-1)[:, :number].tolist()
+            num_chars = np.count_nonzero(self.counts, axis=1).tolist()
+            for col_counts, order, num in zip(self.counts.tolist(), orders, num_chars):
+                vnts.append([(self.alphabet[ind], col_counts[ind]) for ind in order[:num]])
+            return vnts
+        for col_counts, col_first in zip(self.counts, self.first_seen):
+            order = sorted((ind for ind, count in enumerate(col_counts) if count), key=lambda ind: (-col_counts[ind], col_first[ind]))
+            vnts.append([(self.alphabet[ind], col_counts[ind]) for ind in order[:number]])
+        return vnts
+    def variation(self, matrix='BLOSUM62', stdev=False):
+        """See the variation() function. If the profile is tracking a SeqList, the scores are computed from per-column sums of the BLOSUM vectors that are kept up to date as sequences are added or removed. Otherwise each distinct column composition is scored once, and the scores are kept in the module-level `variation_cache`; with numpy, the cache is skipped if nearly all columns are distinct, as it would only be churned."""
+        blosum = get_matrix(matrix)
+        if self.tracked_ref is not None:
+            sums, sq_sums = self._get_variation_sums(blosum)
+            return self._deviations(sums, sq_sums, self.counts, self.num_seqs, stdev)
+        alpha_order = sorted(range(len(self.alphabet)), key=self.alphabet.__getitem__)
+        if np is None:
+            devs = []
+            for col_counts in self.counts:
+                composition = tuple((self.alphabet[ind], col_counts[ind]) for ind in alpha_order if col_counts[ind])
+                key = composition_key(blosum.name, stdev, composition)
+                dev = variation_cache.get(key)
+                if dev is None:
+                    dev = composition_deviation(composition, blosum, stdev)
+                    variation_cache.put(key, dev)
+                devs.append(dev)
+            return devs
+        if self.length == 0:
+            return []
+        uniq_counts, inverse, num_cols = np.unique(self.counts, axis=0, return_inverse=True, return_counts=True)
+        uniq_devs = np.empty(len(uniq_counts), dtype=np.float64)
+        use_cache = len(uniq_counts) <= variation_cache.max_distinct * self.length
+        to_score, keys = [], []
+        for ind, (row, row_cols) in enumerate(zip(uniq_counts.tolist(), num_cols.tolist())):
+            if not use_cache:
+                to_score.append(ind)
+                continue
+            key = composition_key(blosum.name, stdev, ((self.alphabet[a_ind], row[a_ind]) for a_ind in alpha_order if row[a_ind]))
+            dev = variation_cache.get(key, row_cols)
+            if dev is None:
+                to_score.append(ind)
+                keys.append(key)
+            else:
+                uniq_devs[ind] = dev
+        if to_score:
+            counts = uniq_counts[to_score]
+            # Raises the same KeyError as the pure-Python functions for characters not in the matrix
+            vecs = np.array([blosum[c] for c in self.alphabet], dtype=np.float64).reshape(len(self.alphabet), len(blosum.alphabet))
+            scored = self._deviations(counts @ vecs, counts @ (vecs*vecs), counts, counts.sum(axis=1, keepdims=True), stdev)
+            uniq_devs[to_score] = scored
+            for key, dev in zip(keys, scored):
+                variation_cache.put(key, dev)
+        return uniq_devs[inverse.ravel()].tolist()
+    def conservation(self):
+        """Returns the Clustal conservation line: '*' for fully conserved columns, ':' or '.' for columns fully within one of the strong or weak amino acid groups, and ' ' otherwise or if the column contains any gaps. Case-insensitive."""
+        conserv = []
+        for ranked in self.variants():
+            col = {c.upper() for c, _ in ranked}
+            if '-' in col:
+                conserv.append(' ')
+            elif len(col) == 1:
+                conserv.append('*')
+            elif any(col <= aas for aas in clustal_strong_groups):
+                conserv.append(':')
+            elif any(col <= aas for aas in clustal_weak_groups):
+                conserv.append('.')
+            else:
+                conserv.append(' ')
+        return ''.join(conserv)
+
+    # #  Incremental updates
+    def add_sequence(self, seq):
+        """Adds the characters of `seq` (a Sequence or string) to the column counts. Called by a tracked SeqList whenever a sequence is added."""
+        self._update(getattr(seq, 'seq', seq), 1)
+        if self.tracked_ref is not None and not self.order_stale:
+            seqlist = self.tracked_ref()
+            if seqlist is None or not seqlist.data or seqlist.data[-1] is not seq:
+                self.order_stale = True # Inserted out of place
+    def remove_sequence(self, seq):
+        """Subtracts the characters of `seq` (a Sequence or string) from the column counts. Called by a tracked SeqList whenever a sequence is removed."""
+        self._update(getattr(seq, 'seq', seq), -1)
+        if self.tracked_ref is not None:
+            self.order_stale = True
+    def untrack(self):
+        """Stops following the membership changes of the tracked SeqList."""
+        seqlist = self.tracked_ref() if self.tracked_ref is not None else None
+        if seqlist is not None and self in seqlist.trackers:
+            seqlist.trackers.remove(self)
+        self.tracked_ref = None
+
+    # #  Private methods
+    def _build_numpy(self, seqs):
+        enc = encode_alignment(seqs)
+        self.length = enc.shape[1]
+        present, self.counts, self.first_seen = column_byte_counts(enc)
+        self.alphabet = [chr(b) for b in present.tolist()]
+    def _build_python(self, seqs):
+        mapped = mapped_rows(seqs)
+        if mapped is not None and mapped[1] == list(range(mapped[0].num_seqs)):
+            columns = [Counter(col) for col in mapped[0].columns()] # Strided reads from the map
+        else:
+            columns = [Counter(col) for col in zip(*seqs)] # Counters keep the order characters were first encountered
+        alpha_inds = {}
+        for cntr in columns:
+            for c in cntr:
+                alpha_inds.setdefault(c, len(alpha_inds))
+        self.alphabet = list(alpha_inds)
+        self.length = len(columns)
+        for cntr in columns:
+            col_counts, col_first = [0]*len(alpha_inds), [self.num_seqs]*len(alpha_inds)
+            for rank, (c, count) in enumerate(cntr.items()):
+                col_counts[alpha_inds[c]] = count
+                col_first[alpha_inds[c]] = rank
+            self.counts.append(col_counts)
+            self.first_seen.append(col_first)
+    def _refresh_first_seen(self):
+        """Recomputes `first_seen` from the current order of the tracked SeqList."""
+        self.order_stale = False
+        seqlist = self.tracked_ref() if self.tracked_ref is not None else None
+        if seqlist is None or len(seqlist) == 0:
+            return
+        if np is not None:
+            present, _, first_rows = column_byte_counts(encode_alignment(seqlist))
+            byte_inds = {b:ind for ind, b in enumerate(present.tolist())}
+            self.first_seen = np.full((self.length, len(self.alphabet)), len(seqlist), dtype=np.int64)
+            for a_ind, c in enumerate(self.alphabet):
+                b_ind = byte_inds.get(ord(c) if ord(c) < 128 else ord('?'))
+                if b_ind is not None:
+                    self.first_seen[:, a_ind] = first_rows[:, b_ind]
+        else:
+            self.first_seen = [[self.num_seqs]*len(self.alphabet) for _ in range(self.length)]
+            for row, seq in enumerate(seqlist):
+                for col_first, c in zip(self.first_seen, getattr(seq, 'seq', seq)):
+                    ind = self.alpha_inds[c]
+                    if col_first[ind] > row:
+                        col_first[ind] = row
+        self.next_order = len(seqlist)
+    @staticmethod
+    def _deviations(sums, sq_sums, counts, num_seqs, stdev):
+        """Per-column deviations from the sums of the BLOSUM vectors (and of their squares) of the characters in each column, as sqrt(sum(v^2) - sum(v)^2/n) for each dimension."""
+        if np is not None:
+            sq_devs = np.maximum(sq_sums - sums*sums/np.maximum(num_seqs, 1), 0.0)
+            if stdev:
+                devs = np.sqrt(sq_devs.mean(axis=1))
+            else:
+                devs = np.sqrt(sq_devs).mean(axis=1)
+            devs[np.count_nonzero(counts, axis=1) <= 1] = 0.0 # Conserved columns, as in the pure-Python functions
+            return devs.tolist()
+        num_seqs = max(num_seqs, 1)
+        devs = []
+        for col_counts, col_sums, col_sq_sums in zip(counts, sums, sq_sums):
+            if len(col_counts) - col_counts.count(0) <= 1:
+                devs.append(0.0)
+                continue
+            sq_devs = [max(sq_sum - s*s/num_seqs, 0.0) for s, sq_sum in zip(col_sums, col_sq_sums)]
+            if stdev:
+                devs.append(sqrt(sum(sq_devs) / len(sq_devs)))
+            else:
+                devs.append(sum(sqrt(d) for d in sq_devs) / len(sq_devs))
+        return devs
+    def _get_variation_sums(self, blosum):
+        if blosum.name not in self.variation_sums:
+            # Raises the same KeyError as the pure-Python functions for characters not in the matrix
+            vecs = [blosum[c] for c in self.alphabet]
+            if np is not None:
+                vecs = np.array(vecs, dtype=np.float64).reshape(len(self.alphabet), len(blosum.alphabet))
+                sums, sq_sums = self.counts @ vecs, self.counts @ (vecs*vecs)
+            else:
+                sums, sq_sums = [], []
+                for col_counts in self.counts:
+                    col_sums, col_sq_sums = [0.0]*len(blosum.alphabet), [0.0]*len(blosum.alphabet)
+                    for vec, count in zip(vecs, col_counts):
+                        if not count:
+                            continue
+                        for dim, v in enumerate(vec):
+                            col_sums[dim] += v * count
+                            col_sq_sums[dim] += v * v * count
+                    sums.append(col_sums)
+                    sq_sums.append(col_sq_sums)
+            self.variation_sums[blosum.name] = [blosum, vecs, sums, sq_sums]
+        _, _, sums, sq_sums = self.variation_sums[blosum.name]
+        return sums, sq_sums
+    def _update(self, seq_str, delta):
+        if self.num_seqs == 0 and len(seq_str) != self.length:
+            self._reset(len(seq_str))
+        if len(seq_str) != self.length:
+            raise MolecbioAlignmentLengthError("cannot update a ColumnProfile of length {} with a sequence of length {}.".format(self.length, len(seq_str)))
+        new_chars = [c for c in set(seq_str) if c not in self.alpha_inds]
+        if new_chars and delta < 0:
+            raise ValueError("cannot remove a sequence with characters that are not in the ColumnProfile.")
+        for c in new_chars:
+            self._add_character(c)
+        inds = [self.alpha_inds[c] for c in seq_str]
+        if np is not None:
+            cols, inds = np.arange(self.length), np.array(inds, dtype=np.intp)
+            self.counts[cols, inds] += delta
+            if delta > 0:
+                is_new = self.counts[cols, inds] == 1
+                self.first_seen[cols[is_new], inds[is_new]] = self.next_order
+        else:
+            for col_counts, col_first, ind in zip(self.counts, self.first_seen, inds):
+                col_counts[ind] += delta
+                if delta > 0 and col_counts[ind] == 1:
+                    col_first[ind] = self.next_order
+        self.num_seqs += delta
+        if delta > 0:
+            self.next_order += 1
+        for name, (_, vecs, sums, sq_sums) in self.variation_sums.items():
+            if np is not None:
+                seq_vecs = vecs[inds]
+                sums += delta * seq_vecs
+                sq_sums += delta * seq_vecs * seq_vecs
+            else:
+                for col_sums, col_sq_sums, ind in zip(sums, sq_sums, inds):
+                    for dim, v in enumerate(vecs[ind]):
+                        col_sums[dim] += delta * v
+                        col_sq_sums[dim] += delta * v * v
+    def _add_character(self, c):
+        self.alpha_inds[c] = len(self.alphabet)
+        self.alphabet.append(c)
+        if np is not None:
+            self.counts = np.hstack((self.counts, np.zeros((self.length, 1), dtype=self.counts.dtype)))
+            self.first_seen = np.hstack((self.first_seen, np.zeros((self.length, 1), dtype=self.first_seen.dtype)))
+        else:
+            for col_counts, col_first in zip(self.counts, self.first_seen):
+                col_counts.append(0)
+                col_first.append(0)
+        for name, entry in list(self.variation_sums.items()):
+            blosum, vecs = entry[0], entry[1]
+            try:
+                vec = blosum[c]
+            except KeyError:
+                del self.variation_sums[name] # variation() will raise the KeyError if it is called
+                continue
+            if np is not None:
+                entry[1] = np.vstack((vecs, np.array(vec, dtype=np.float64)))
+            else:
+                vecs.append(vec)
+    def _reset(self, length):
+        """Empties the profile, setting it to the given alignment `length`."""
+        self.length = length
+        self.alphabet, self.alpha_inds, self.variation_sums = [], {}, {}
+        if np is not None:
+            self.counts = np.zeros((length, 0), dtype=np.int64)
+            self.first_seen = np.zeros((length, 0), dtype=np.int64)
+        else:
+            self.counts = [[] for _ in range(length)]
+            self.first_seen = [[] for _ in range(length)]
+
+
+class CompositionCache():
+    """
+    A bounded cache of per-column scores keyed by column composition, evicting the least recently used entries once it holds `maxsize` entries or an estimated `max_bytes`. Used by ColumnProfile.variation() through the module-level `variation_cache`, with the compact string keys made by composition_key()."""
+    def __init__(self, maxsize=8192, max_bytes=2*2**20, max_distinct=0.9):
+        # #  Public attributes
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.max_distinct = max_distinct # ColumnProfile.variation() bypasses the cache if more than this fraction of the columns are distinct
+        self.hits = 0 # Number of columns whose score was reused
+        self.misses = 0 # Number of compositions that had to be scored
+        self.nbytes = 0 # Estimated memory held by the entries
+        # #  Private attributes
+        self.data = OrderedDict()
+    def get(self, key, num_cols=1):
+        """Returns the cached score for `key` or None. `num_cols` is the number of columns sharing this composition; if it isn't cached, all but the first of them count as hits as the score is only computed once."""
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += num_cols
+            return self.data[key]
+        self.misses += 1
+        self.hits += num_cols - 1
+        return None
+    def put(self, key, value):
+        if key not in self.data:
+            self.nbytes += self.entry_size(key)
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while self.data and (len(self.data) > self.maxsize or self.nbytes > self.max_bytes):
+            old_key, _ = self.data.popitem(last=False)
+            self.nbytes -= self.entry_size(old_key)
+    def clear(self):
+        """Empties the cache and resets the statistics."""
+        self.data.clear()
+        self.hits, self.misses, self.nbytes = 0, 0, 0
+    def info(self):
+        """Returns a named tuple of (hits, misses, maxsize, currsize, nbytes, hit_rate)."""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data), self.nbytes, self.hit_rate)
+    @staticmethod
+    def entry_size(key):
+        """Estimated bytes held by one entry: the key, the float score, and the OrderedDict bookkeeping."""
+        return sys.getsizeof(key) + 24 + 100
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'nbytes', 'hit_rate'])
+def composition_key(matrix_name, stdev, composition):
+    """Returns a compact string key for `composition`, an iterable of (character, count) sorted by character. Each character is followed by its count and a null, so keys are unambiguous."""
+    return '{}\0{:d}\0{}'.format(matrix_name, bool(stdev), ''.join('{}{}\0'.format(c, count) for c, count in composition))
+variation_cache = CompositionCache() # Shared by all ColumnProfiles
+
+
+class _RollingMean():
+    """Rolling accumulators for sliding_window(). Values are added and removed by their index in `values`, in increasing order."""
+    def __init__(self, values):
+        self.values = values
+        self.total, self.count = 0.0, 0
+    def add(self, ind):
+        self.total += self.values[ind]
+        self.count += 1
+    def remove(self, ind):
+        self.total -= self.values[ind]
+        self.count -= 1
+    def value(self):
+        return self.total / self.count
+class _RollingMax():
+    def __init__(self, values):
+        self.values = values
+        self.inds = deque() # Indices of decreasing values; the front is the current max
+    def add(self, ind):
+        while self.inds and self.values[self.inds[-1]] <= self.values[ind]:
+            self.inds.pop()
+        self.inds.append(ind)
+    def remove(self, ind):
+        if self.inds[0] == ind:
+            self.inds.popleft()
+    def value(self):
+        return self.values[self.inds[0]]
+class _RollingMedian():
+    def __init__(self, values):
+        self.values = values
+        self.low, self.high = [], [] # Max-heap of the lower half as (-value, ind), and min-heap of the upper half as (value, ind)
+        self.num_low, self.num_high = 0, 0 # Heap sizes, not counting removed entries
+        self.in_low = {} # ind: whether it was placed into the low heap
+        self.removed = set() # Entries are only deleted from the heaps once they reach the top
+    def add(self, ind):
+        val = self.values[ind]
+        self._prune()
+        if self.num_low == 0 or val <= -self.low[0][0]:
+            heappush(self.low, (-val, ind))
+            self.in_low[ind] = True
+            self.num_low += 1
+        else:
+            heappush(self.high, (val, ind))
+            self.in_low[ind] = False
+            self.num_high += 1
+        self._balance()
+    def remove(self, ind):
+        self.removed.add(ind)
+        if self.in_low.pop(ind):
+            self.num_low -= 1
+        else:
+            self.num_high -= 1
+        self._balance()
+    def value(self):
+        self._prune()
+        if self.num_low > self.num_high:
+            return -self.low[0][0]
+        return (-self.low[0][0] + self.high[0][0]) / 2
+    def _balance(self):
+        self._prune()
+        while self.num_low > self.num_high + 1:
+            neg_val, ind = heappop(self.low)
+            heappush(self.high, (-neg_val, ind))
+            self.in_low[ind] = False
+            self.num_low, self.num_high = self.num_low-1, self.num_high+1
+            self._prune()
+        while self.num_low < self.num_high:
+            val, ind = heappop(self.high)
+            heappush(self.low, (-val, ind))
+            self.in_low[ind] = True
+            self.num_low, self.num_high = self.num_low+1, self.num_high-1
+            self._prune()
+    def _prune(self):
+        for heap in (self.low, self.high):
+            while heap and heap[0][1] in self.removed:
+                self.removed.discard(heappop(heap)[1])
 
 
 # # #  Errors
@@ -1,19 +1,23 @@
 """
-parse functions return None if the data is invalid for that format. load functions throw an error.
+parse functions return None if the data is invalid for that format. load functions throw an error. iter functions are generators that yield each sequence as it is parsed, and throw an error on invalid data.
 """
 # Author: Dave Curran
 # Date: Aug 2022
 
-import weakref # Used to avoid circular references between Sequence & SeqList
-from collections import UserList
+import itertools, io, os, sys, json, struct, hashlib, mmap
+import gzip, bz2, lzma
+from array import array
+from collections import UserList, Counter
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy as np
+except ImportError:
+    np = None # AlignmentMatrix.array is then None, and rows and columns are memoryviews
 
 
 # TODO
 # finish the phylip writing methods.
-# I shouldn't rely on the code to check if names_cache exists, and rebuild_cache() if not. Just decorate a centralized getter function to do that.
 # could rename `make_unique()` to something like `filter_redundant()`; decide on some function nomenclature about what `remove_`, `fileter_`, or `make_` mean for function names and keep it standard.
-# remove_shorter() takes quite a long time on 262k sequences, likely because of the `remove()` call. Provide a 'filter_shorter()' method as well, that just returns a new SeqList instead of removing.
-#  - it's probably the _deregister calls that are slow. could maybe have an option to prevent them
 # once this is decent, put a copy into a new molecbio.sequ file. eventually i need to replace it.
 # translate, inverse, complements
 # quality, aln_identity; probably simpler to merge that module with this one. If i'm trying to avoid needlessly importing numpy (why?), could hold off on the import until calling a relevant method.
@@ -22,173 +26,455 @@ from collections import UserList
 
 
 # # #  Package file I/O functions
-def save_fasta(seqlist, filename, line=None, spaces=False, numbers=False):
-    """line is an int indicating the length of each line. spaces and numbers are booleans."""
-    with open(filename, 'w') as f:
-        f.write(seqlist.to_fasta(line=line, spaces=spaces, numbers=numbers))
-def save_fasta_sequences(seqlist, filename, line=None, spaces=False, numbers=False):
+def save_fasta(seqlist, filename, line=None, spaces=False, numbers=False, compression=None):
+    """line is an int indicating the length of each line. spaces and numbers are booleans. `compression` can be one of 'gz', 'bz2', or 'xz' to compress the file as it's written."""
+    with open_seq_file(filename, 'w', compression) as f:
+        seqlist.write_fasta(f, line=line, spaces=spaces, numbers=numbers)
+def save_fasta_sequences(seqlist, filename, line=None, spaces=False, numbers=False, compression=None):
     """Designed for alignments, removes gaps and saves as FASTA sequences without modifying the passed `seqlist`."""
     new_seqs = seqlist.copy()
     new_seqs.strip_gaps()
-    with open(filename, 'w') as f:
-        f.write(seqlist.to_fasta(line=line, spaces=spaces, numbers=numbers))
-def save_clustal(seqlist, filename, numbers=True, name_len=None):
-    with open(filename, 'w') as f:
-        f.write(seqlist.to_clustal(numbers=numbers, name_len=name_len))
-def save_phylip(seqlist, filename, kind='interleaved', strict=False, per_line=70, chunk_size=10):
-    with open(filename, 'w') as f:
-        f.write(seqlist.to_phylip(kind=kind, strict=strict, per_line=per_line, chunk_size=chunk_size))
-
-def load(filename, only_these=None):
-    """Attempts to parse the sequence file using all known formats."""
-    with open(filename) as f:
-        first_line = f.readline()
-        f.seek(0)
-        line_split = first_line.split()
-        if first_line.upper().startswith(('CLUSTAL W', 'CLUSTALW')):
-            seqs = parse_clustal(f, only_these)
-            method = 'Clustal'
-        elif len(line_split)==2 and line_split[0].isdigit() and line_split[1].isdigit():
-            seqs = parse_phylip(f, only_these)
-            method = 'Phylip'
+    with open_seq_file(filename, 'w', compression) as f:
+        new_seqs.write_fasta(f, line=line, spaces=spaces, numbers=numbers)
+def save_clustal(seqlist, filename, numbers=True, name_len=None, compression=None):
+    with open_seq_file(filename, 'w', compression) as f:
+        seqlist.write_clustal(f, numbers=numbers, name_len=name_len)
+def save_phylip(seqlist, filename, kind='interleaved', strict=False, per_line=70, chunk_size=10, compression=None):
+    with open_seq_file(filename, 'w', compression) as f:
+        seqlist.write_phylip(f, kind=kind, strict=strict, per_line=per_line, chunk_size=chunk_size)
+
+def load(filename, only_these=None, cache=None, workers=None):
+    """Attempts to parse the sequence file using all known formats. Files compressed with gzip, bzip2, or xz are detected and decompressed as they are parsed. `cache` can be a SeqCache, or True to use a cache file next to `filename`; the whole file is then cached, and `only_these` is applied afterwards. If `workers` is an int > 1, a FASTA file is parsed in a pool of that many processes."""
+    if cache:
+        if cache is True:
+            cache = SeqCache()
+        seqs = cache.load(filename)
+        if seqs is None:
+            seqs = load(filename, workers=workers)
+            cache.save(filename, seqs)
+        if only_these:
+            seqs = SeqList(select_names(seqs, only_these))
+            if not seqs:
+                raise MolecbioFileFormatError("no sequences in '{}' have names starting with those in `only_these`.".format(filename))
+        return seqs
+    with open_seq_file(filename, 'rb') as f:
+        first_line = b''.join(f.peek(2**16).splitlines()[:1]).decode('utf-8', 'replace') # Peeking avoids a second pass over a decompressed stream
+        method = sniff_format(first_line)
+        if method == 'FASTA' and workers and workers > 1 and not file_compression(filename):
+            seqs = parse_fasta_parallel(filename, only_these, workers)
         else:
-            seqs = parse_fasta(f, only_these)
-            method = 'FASTA'
+            lines = io.TextIOWrapper(f)
+            if method == 'Clustal':
+                seqs = parse_clustal(lines, only_these)
+            elif method == 'Phylip':
+                seqs = parse_phylip(lines, only_these)
+            else:
+                seqs = parse_fasta(lines, only_these)
+            lines.detach()
     if seqs is None:
         raise MolecbioFileFormatError("could not load '{}' as a {}-format file of sequences.".format(filename, method))
     return seqs
-def load_fasta(filename, only_these=None):
-    """If given, only_these should be a tuple or collection of strings. Only sequences with names starting with at least one of those strings will be returned."""
-    with open(filename) as f:
-        seqs = parse_fasta(f, only_these)
+def load_mapped(filename, only_these=None, cache=None):
+    """Loads `filename` like load(), but returns MappedSequences whose residues are read on demand from a memory map of its SeqCache file, so very large alignments don't need to fit in memory. `cache` is the SeqCache to use, by default one with a cache file next to `filename`; the cache file is written first if needed. Falls back to load() if the cache can't be mapped, for example if the residues aren't all ASCII."""
+    if cache is None:
+        cache = SeqCache()
+    seqs = cache.map(filename, only_these)
+    if seqs is None:
+        cache.save(filename, iter_load(filename)) # Streamed, so the whole file is never held in memory
+        seqs = cache.map(filename, only_these)
+        if seqs is None:
+            return load(filename, only_these, cache=cache)
+    if not seqs:
+        raise MolecbioFileFormatError("no sequences could be loaded from '{}'.".format(filename))
+    return seqs
+def load_matrix(filename, only_these=None):
+    """Loads the alignment in `filename` straight into an AlignmentMatrix, streaming the records into one buffer without making a Sequence for each. Raises a MolecbioFileFormatError if no sequences could be loaded, or a MolecbioInvalidAlignmentError if they are not all the same length or contain non-ASCII characters."""
+    names, residues, aln_len = [], bytearray(), None
+    for name, seq in iter_load(filename, only_these, as_tuples=True):
+        if aln_len is None:
+            aln_len = len(seq)
+        elif len(seq) != aln_len:
+            raise MolecbioInvalidAlignmentError("sequence '{}' in '{}' has a length of {}, not {}.".format(name, filename, len(seq), aln_len))
+        if not seq.isascii():
+            raise MolecbioInvalidAlignmentError("sequence '{}' in '{}' contains non-ASCII characters.".format(name, filename))
+        names.append(name)
+        residues += seq.encode('ascii')
+    if not names:
+        raise MolecbioFileFormatError("no sequences could be loaded from '{}'.".format(filename))
+    return AlignmentMatrix(names, residues, aln_len)
+def load_fasta(filename, only_these=None, index=False, workers=None):
+    """If given, only_these should be a tuple or collection of strings, or a NameSelector. Only sequences with names starting with at least one of those strings will be returned. If `index` is True and `only_these` is given, the sequences are read through a FastaIndex, so only their bytes are read. If `workers` is an int > 1, the file is parsed in a pool of that many processes."""
+    if index and only_these and not file_compression(filename):
+        seqs = FastaIndex(filename).select(only_these) or None
+    elif workers and workers > 1:
+        seqs = parse_fasta_parallel(filename, only_these, workers)
+    else:
+        seqs = parse_fasta_file(filename, only_these)
     if seqs is None:
         raise MolecbioFileFormatError("could not load '{}' as a FASTA file.".format(filename))
     return seqs
 def load_clustal(filename, only_these=None):
-    with open(filename) as f:
+    with open_seq_file(filename) as f:
         seqs = parse_clustal(f, only_these)
     if seqs is None:
         raise MolecbioFileFormatError("could not load '{}' as a Clustal alignment file.".format(filename))
     return seqs
 def load_phylip(filename, only_these=None, kind='auto', strict=False):
-    with open(filename) as f:
+    with open_seq_file(filename) as f:
         seqs = parse_phylip(f, only_these, kind, strict)
     if seqs is None:
         raise MolecbioFileFormatError("could not load '{}' as a Phylip alignment file.".format(filename))
     return seqs
+def open_seq_file(filename, mode='r', compression=None):
+    """Opens a sequence file in text mode, or binary if `mode` is 'rb'. For reading, gzip, bzip2, and xz files are detected from their magic bytes and decompressed as they are read. For writing (`mode` 'w'), `compression` can be one of 'gz', 'bz2', or 'xz'."""
+    if mode.startswith('r'):
+        compression = file_compression(filename)
+    elif compression is not None and compression not in compression_openers:
+        raise ValueError("compression must be None or one of {}, not '{}'.".format(', '.join(compression_openers), compression))
+    if compression is None:
+        return open(filename, mode)
+    return compression_openers[compression](filename, mode if 'b' in mode else mode + 't')
+def file_compression(filename):
+    """Returns 'gz', 'bz2', or 'xz' if the file starts with the magic bytes of that format, otherwise None."""
+    with open(filename, 'rb') as f:
+        start = f.read(max(map(len, compression_magic)))
+    for magic, compression in compression_magic.items():
+        if start.startswith(magic):
+            return compression
+    return None
+def sniff_format(first_line):
+    """Returns 'Clustal', 'Phylip', or 'FASTA' based on the first line of a sequence file."""
+    line_split = first_line.split()
+    if first_line.upper().startswith(('CLUSTAL W', 'CLUSTALW')):
+        return 'Clustal'
+    elif len(line_split)==2 and line_split[0].isdigit() and line_split[1].isdigit():
+        return 'Phylip'
+    else:
+        return 'FASTA'
 
 def parse_fasta(lines, only_these=None):
+    seqs = SeqList(iter_fasta(lines, only_these))
+    if seqs:
+        return seqs
+    else:
+        return None
+def parse_fasta_file(filename, only_these=None):
+    """Opens the file, decompressing it if needed, and parses it with parse_fasta()."""
+    with open_seq_file(filename) as f:
+        return parse_fasta(f, only_these)
+def parse_fasta_parallel(filename, only_these=None, workers=None, range_size=2**26):
+    """Parallel version of parse_fasta_file(). The file is split into byte ranges of about `range_size` that each start at a '>' beginning a line, and the ranges are parsed in a pool of `workers` processes (one per CPU if None). `only_these` is applied in the workers, and each range is returned packed into a few bytes objects to keep the pickling cheap. If any range can't be decoded, the whole file is parsed by parse_fasta_file() instead, so the result is always identical."""
+    workers = workers or os.cpu_count() or 1
+    if file_compression(filename):
+        return parse_fasta_file(filename, only_these) # Compressed streams can't be split into byte ranges
+    with open(filename, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        ranges = fasta_byte_ranges(f, max(workers, -(-size // range_size)))
+    if workers < 2 or len(ranges) < 2:
+        return parse_fasta_file(filename, only_these)
+    only_these = name_selector(only_these)
+    tasks = [(filename, start, end, only_these) for start, end in ranges]
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        packed = list(pool.map(_parse_fasta_range, tasks))
+    if None in packed:
+        return parse_fasta_file(filename, only_these)
+    seqs = SeqList([seq for names, lengths, residues in packed for seq in _unpack_records(names, lengths, residues)])
     if only_these:
-        only_these = tuple(only_these)
-    seqs = SeqList()
-    name, seq_buff = None, []
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        if line[0]=='>':
-            if name:
-                if not only_these or name.startswith(only_these):
-                    seq = Sequence(name, ''.join(seq_buff))
-                    seqs.append(seq)
-            name = line[1:]
-            seq_buff = []
-        else:
-            seq_buff.append(line)
-    if name:
-        seq = Sequence(name, ''.join(seq_buff))
-        seqs.append(seq)
+        for seq in seqs:
+            only_these(seq.name) # The workers matched copies of the selector, so the found names are recorded here
     if seqs:
         return seqs
     else:
         return None
+def fasta_byte_ranges(f, num_ranges, window=2**16):
+    """Returns a list of (start, end) byte offsets splitting the seekable binary file `f` into about `num_ranges` pieces. Every range after the first starts at a '>' that begins a line, so each holds only complete records. Fewer ranges are returned if there aren't enough records."""
+    size = f.seek(0, os.SEEK_END)
+    bounds = [0]
+    for i in range(1, num_ranges):
+        pos = max(size * i // num_ranges, bounds[-1])
+        f.seek(pos)
+        tail, boundary = b'', None
+        for block in iter(lambda: f.read(window), b''):
+            ind = (tail + block).find(b'\n>')
+            if ind != -1:
+                boundary = pos - len(tail) + ind + 1
+                break
+            pos += len(block)
+            tail = block[-1:]
+        if boundary is None:
+            break
+        bounds.append(boundary)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
 def parse_clustal(lines, only_these=None):
-    if only_these:
-        only_these = tuple(only_these)
-    for line in lines: # Ensures first line is right
-        if not line.upper().startswith(('CLUSTAL W', 'CLUSTALW')):
-            return None
-        break
-    if isinstance(lines, list):
-        lines = lines[1:] # allows `lines` to be a file obj or actual list of strings.
-    seq_dict = {}
-    for line in lines:
-        if line.startswith((' ','\t','\n')):
-            continue # skips empty + conservation lines
-        data = line.split()
-        name, seq = data[:2]
-        seq_dict.setdefault(name, []).append(seq)
-    seqs = SeqList()
-    for name, list_seq in seq_dict.items():
-        if not only_these or name.startswith(only_these):
-            seq = Sequence(name, ''.join(list_seq))
-            seqs.append(seq)
+    try:
+        seqs = SeqList(iter_clustal(lines, only_these))
+    except MolecbioFileFormatError:
+        return None
     if seqs:
         return seqs
     else:
         return None
 def parse_phylip(lines, only_these=None, kind='auto', strict=False):
     """`kind` can be 'auto', 'interleaved', 'i', 'sequential', or 's'. If `strict` is True, the format is from PhyML with name lengths of exactly 10. If False, just expects a space between the name and sequence."""
-    if only_these:
-        only_these = tuple(only_these)
-    for line in lines: # Ensures first line is right
-        data = line.split()
-        if len(data) != 2 or not data[0].isdigit() or not data[1].isdigit():
-            return None
-        num_seqs = int(data[0])
-        aln_len = int(data[1])
-        break
-    if isinstance(lines, list):
-        lines = lines[1:]
-    else:
-        lines = lines.readlines()
-    lines = [line.strip() for line in lines if line.strip()] # removes blank lines
-    if len(lines) % num_seqs != 0:
-        return None # Needs to be an equal # of lines associated with each sequence
-    kind = kind.lower()
-    if kind == 'auto':
-        return parse_phylip_lines(lines, only_these, True, strict, num_seqs, aln_len) or parse_phylip_lines(lines, only_these, True, not strict, num_seqs, aln_len) or parse_phylip_lines(lines, only_these, False, strict, num_seqs, aln_len) or parse_phylip_lines(lines, only_these, False, not strict, num_seqs, aln_len)
-    elif kind in ('interleaved', 'i'):
-        return parse_phylip_lines(lines, only_these, True, strict, num_seqs, aln_len) or parse_phylip_lines(lines, only_these, True, not strict, num_seqs, aln_len)
-    elif kind in ('sequential', 's'):
-        return parse_phylip_lines(lines, only_these, False, strict, num_seqs, aln_len) or parse_phylip_lines(lines, only_these, False, not strict, num_seqs, aln_len)
+    try:
+        seqs = SeqList(iter_phylip(lines, only_these, kind, strict))
+    except MolecbioFileFormatError:
+        return None
+    if seqs:
+        return seqs
     else:
-        raise ValueError("unrecognized `kind` argument '{}'. It must be one of: 'auto', 'interleaved', 'i', 'sequential', or 's'.".format(kind))
+        return None
 def parse_phylip_lines(lines, only_these, is_interleaved, strict, num_seqs, aln_len):
-    strict_len = 10 # To be compatible with PhyML and similar software
-    seqs = SeqList()
+    """Returns a list of (name, sequence) tuples, or None if the lines do not fit the given layout. All sequences are validated, then filtered by `only_these`."""
+    only_these = name_selector(only_these)
+    seqs = []
     lines_per = int(len(lines) / num_seqs)
     for seq_ind in range(num_seqs):
         if is_interleaved:
             first_ind = seq_ind
         else:
             first_ind = seq_ind * lines_per
-        if strict:
-            name = lines[first_ind][:strict_len].strip()
-            seq_buff = lines[first_ind][strict_len:].split()
-        else:
-            line_data = lines[first_ind].split()
-            name = line_data[0]
-            seq_buff = line_data[1:]
-        if only_these and not name.startswith(only_these):
-            continue
+        name, seq_buff = phylip_name_line(lines[first_ind], strict)
+        seq_buff = [seq_buff]
         for ind in range(1, lines_per):
             if is_interleaved:
                 next_ind = first_ind + ind * num_seqs
             else:
                 next_ind = first_ind + ind
             seq_buff.extend(lines[next_ind].split())
-        seq = Sequence(name, sequence=''.join(seq_buff))
+        seq = ''.join(seq_buff)
         if len(seq) != aln_len:
             return None
-        seqs.append(seq)
-    if len(seqs) != num_seqs:
+        if not only_these or only_these(name):
+            seqs.append((name, seq))
+    return seqs
+def phylip_name_line(line, strict):
+    """Returns the name and the residues from the first line of a Phylip record."""
+    strict_len = 10 # To be compatible with PhyML and similar software
+    if strict:
+        return line[:strict_len].strip(), ''.join(line[strict_len:].split())
+    line_data = line.split()
+    return line_data[0], ''.join(line_data[1:])
+def phylip_layout_fits(lines, complete, is_interleaved, strict, num_seqs, aln_len):
+    """Checks the stripped, non-blank `lines` from the start of a Phylip file against one layout, returning (fits, lines_per, num_placed). `fits` is False only if the layout can't be valid for the whole file; if `complete` is False, more lines follow. For the sequential layout `lines_per` is the number of lines used by the first sequence (None if not yet known), and `num_placed` is the number of sequences that fit exactly."""
+    if is_interleaved:
+        lengths = [len(phylip_name_line(line, strict)[1]) for line in lines[:num_seqs]]
+        for ind in range(num_seqs, len(lines)):
+            lengths[ind % num_seqs] += len(''.join(lines[ind].split()))
+        if complete:
+            return (len(lines) == num_seqs * (len(lines) // num_seqs) > 0 and all(length == aln_len for length in lengths)), None, None
+        return all(length <= aln_len for length in lengths), None, None
+    lines_per, first_ind, num_placed = None, 0, 0
+    while first_ind < len(lines):
+        if num_placed == num_seqs:
+            return False, lines_per, num_placed # Lines remain after the last sequence
+        length = len(phylip_name_line(lines[first_ind], strict)[1])
+        num_lines = 1
+        while (length < aln_len if lines_per is None else num_lines < lines_per):
+            if first_ind + num_lines == len(lines):
+                return not complete, lines_per, num_placed # Ran out of lines partway through a sequence
+            length += len(''.join(lines[first_ind + num_lines].split()))
+            num_lines += 1
+        if length != aln_len:
+            return False, lines_per, num_placed
+        if lines_per is None:
+            lines_per = num_lines
+        first_ind += num_lines
+        num_placed += 1
+    if complete:
+        return num_placed == num_seqs, lines_per, num_placed
+    return True, lines_per, num_placed
+
+# #  Streaming parsers
+def iter_load(filename, only_these=None, as_tuples=False):
+    """Generator version of load(), yielding each Sequence as it is parsed, or (name, sequence) tuples if `as_tuples` is True. The file is read only once, and is closed when the generator is exhausted or closed. Raises a MolecbioFileFormatError if the file is not valid for its detected format."""
+    with open_seq_file(filename) as f:
+        first_line = f.readline()
+        lines = itertools.chain([first_line], f)
+        method = sniff_format(first_line)
+        if method == 'Clustal':
+            yield from iter_clustal(lines, only_these, as_tuples)
+        elif method == 'Phylip':
+            yield from iter_phylip(lines, only_these, as_tuples=as_tuples)
+        else:
+            yield from iter_fasta(lines, only_these, as_tuples)
+def iter_fasta(lines, only_these=None, as_tuples=False):
+    """Yields each record from `lines` (a file object or other iterable of strings) as soon as it has been read, so memory use is bounded by the largest record. The sequence lines of records not selected by `only_these` are skipped without being stored."""
+    only_these = name_selector(only_these)
+    name, seq_buff, keep = None, [], False
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line[0]=='>':
+            if keep:
+                yield _new_record(name, ''.join(seq_buff), as_tuples)
+            name = line[1:]
+            seq_buff = []
+            keep = bool(name) and (not only_these or only_these(name))
+        elif keep:
+            seq_buff.append(line)
+    if keep:
+        yield _new_record(name, ''.join(seq_buff), as_tuples)
+def iter_clustal(lines, only_these=None, as_tuples=False):
+    """Yields each record from the Clustal-formatted `lines`. As the format is interleaved, the sequence fragments selected by `only_these` must be held until the end of the file; other fragments are never stored. Raises a MolecbioFileFormatError if the first line is not a Clustal header."""
+    only_these = name_selector(only_these)
+    lines = iter(lines)
+    if not next(lines, '').upper().startswith(('CLUSTAL W', 'CLUSTALW')): # Ensures first line is right
+        raise MolecbioFileFormatError("the first line is not a Clustal header.")
+    seq_dict = {}
+    for line in lines:
+        if line.startswith((' ','\t','\n')):
+            continue # skips empty + conservation lines
+        data = line.split()
+        name, seq = data[:2]
+        if only_these and not only_these(name):
+            continue
+        seq_dict.setdefault(name, []).append(seq)
+    for name, list_seq in seq_dict.items():
+        yield _new_record(name, ''.join(list_seq), as_tuples)
+def iter_phylip(lines, only_these=None, kind='auto', strict=False, as_tuples=False):
+    """Yields each record from the Phylip-formatted `lines`; see parse_phylip() for `kind` and `strict`. The layouts are tried in the same order as parse_phylip_lines() was originally: interleaved before sequential, so a file valid as both is parsed as interleaved. Lines are read until every interleaved layout is ruled out (or the file ends); a sequential file is then parsed one record at a time from there, while interleaved files have to be held in memory. Raises a MolecbioFileFormatError if the data do not fit any allowed layout, which for sequential files may only be found after some records have been yielded."""
+    only_these = name_selector(only_these)
+    kind = kind.lower()
+    if kind == 'auto':
+        layouts = ((True, strict), (True, not strict), (False, strict), (False, not strict))
+    elif kind in ('interleaved', 'i'):
+        layouts = ((True, strict), (True, not strict))
+    elif kind in ('sequential', 's'):
+        layouts = ((False, strict), (False, not strict))
+    else:
+        raise ValueError("unrecognized `kind` argument '{}'. It must be one of: 'auto', 'interleaved', 'i', 'sequential', or 's'.".format(kind))
+    lines = iter(lines)
+    data = next(lines, '').split() # Ensures first line is right
+    if len(data) != 2 or not data[0].isdigit() or not data[1].isdigit() or int(data[0]) == 0:
+        raise MolecbioFileFormatError("the first line is not a Phylip header.")
+    num_seqs = int(data[0])
+    aln_len = int(data[1])
+    lines = (line for line in map(str.strip, lines) if line) # removes blank lines
+    # Reads lines from the start until the interleaved layouts are ruled out and each sequential layout has failed or placed two sequences, with every name mode agreeing on the lines per sequence.
+    head, complete = [], False
+    confirmed = min(2, num_seqs)
+    while not complete:
+        more = list(itertools.islice(lines, max(64, len(head))))
+        complete = len(more) < max(64, len(head))
+        head.extend(more)
+        fits = [phylip_layout_fits(head, complete, is_interleaved, is_strict, num_seqs, aln_len) for is_interleaved, is_strict in layouts]
+        if any(fit for (fit, _, _), (is_interleaved, _) in zip(fits, layouts) if is_interleaved):
+            continue # Interleaved is tried first, so it has to be ruled out by the lines or confirmed by the whole file
+        sequential_fits = [(lines_per, num_placed) for (fit, lines_per, num_placed), (is_interleaved, _) in zip(fits, layouts) if fit and not is_interleaved]
+        if all(num_placed >= confirmed for _, num_placed in sequential_fits) and len({lines_per for lines_per, _ in sequential_fits}) <= 1:
+            break
+    layout_ind = next((ind for ind, (fit, _, _) in enumerate(fits) if fit), None) # The first layout that fits
+    if layout_ind is None:
+        raise MolecbioFileFormatError("the sequences do not fit any of the allowed Phylip layouts.")
+    if layouts[layout_ind][0]: # Interleaved
+        head.extend(lines)
+        if len(head) % num_seqs != 0:
+            raise MolecbioFileFormatError("the number of lines is not a multiple of the number of sequences.") # Needs to be an equal # of lines associated with each sequence
+        for is_interleaved, is_strict in layouts[layout_ind:]:
+            seqs = parse_phylip_lines(head, only_these, is_interleaved, is_strict, num_seqs, aln_len)
+            if seqs is not None:
+                break
+        else:
+            raise MolecbioFileFormatError("the sequences do not fit any of the allowed Phylip layouts.")
+        for name, seq in seqs:
+            yield _new_record(name, seq, as_tuples)
+        return
+    # Sequential. Name modes that fit equally are kept, as records that fit both are identical.
+    lines_per = fits[layout_ind][1]
+    modes = [is_strict for (is_interleaved, is_strict), (fit, mode_lines, _) in zip(layouts[layout_ind:], fits[layout_ind:]) if not is_interleaved and fit and mode_lines == lines_per]
+    lines = itertools.chain(head, lines)
+    for seq_ind in range(num_seqs):
+        record_lines = list(itertools.islice(lines, lines_per))
+        if len(record_lines) < lines_per:
+            raise MolecbioFileFormatError("the file ended before all {} sequences were read.".format(num_seqs))
+        rest = ''.join(''.join(record_lines[1:]).split())
+        record = None
+        for is_strict in list(modes):
+            name, seq = phylip_name_line(record_lines[0], is_strict)
+            if len(seq) + len(rest) != aln_len:
+                modes.remove(is_strict)
+            elif record is None:
+                record = (name, seq + rest)
+        if record is None:
+            raise MolecbioFileFormatError("sequence {} does not have a length of {}.".format(seq_ind + 1, aln_len))
+        if not only_these or only_these(record[0]):
+            yield _new_record(record[0], record[1], as_tuples)
+    if next(lines, None) is not None:
+        raise MolecbioFileFormatError("there are more lines than expected for {} sequences.".format(num_seqs))
+def select_names(seqs, only_these):
+    """Returns a list of the sequences in `seqs` with names starting with any of the strings in `only_these`, or selected by it if it is a NameSelector."""
+    only_these = name_selector(only_these)
+    return [seq for seq in seqs if only_these(seq.name)]
+def mapped_rows(seqs):
+    """Returns the MappedSeqFile or AlignmentMatrix shared by all of `seqs` and a list of their rows in it, or None if they aren't all unmodified MappedSequences from one alignment. An AlignmentMatrix is returned with all of its rows. Lets column-oriented code read the N x L matrix directly."""
+    if isinstance(seqs, AlignmentMatrix):
+        return seqs, list(range(seqs.num_seqs))
+    mapping, rows = None, []
+    for seq in seqs:
+        if getattr(seq, 'mapping', None) is None:
+            return None
+        elif mapping is None:
+            mapping = seq.mapping
+        elif seq.mapping is not mapping:
+            return None
+        rows.append(seq.row)
+    if mapping is None or mapping.aln_len is None:
         return None
+    return mapping, rows
+def name_selector(only_these):
+    """Returns `only_these` as a NameSelector, or None if it is empty. A NameSelector is returned as is, so that it records the names found."""
+    if not only_these:
+        return None
+    elif isinstance(only_these, NameSelector):
+        return only_these
+    return NameSelector(only_these)
+def _parse_fasta_range(args):
+    """Pool task for parse_fasta_parallel(). Returns the records in one byte range packed by _pack_records(), or None if the range can't be decoded."""
+    filename, start, end, only_these = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    return _pack_records(list(iter_fasta(io.StringIO(text, newline=None), only_these, as_tuples=True))) # Universal newlines, as in text mode
+def _pack_records(records):
+    """Packs (name, sequence) tuples into (names, lengths, residues) bytes objects, which pickle far more cheaply than the tuples."""
+    names = '\n'.join(name for name, seq in records).encode('utf-8')
+    lengths = array('q', (len(seq) for name, seq in records)).tobytes()
+    residues = ''.join(seq for name, seq in records).encode('utf-8')
+    return names, lengths, residues
+def _unpack_records(names, lengths, residues, stats=None):
+    """Returns a list of Sequences from the bytes made by _pack_records(). `lengths` are in characters. If given, `stats` holds the packed nongaps then gaps of every sequence, as stored by SeqCache, which are cached on the new Sequences."""
+    if not lengths:
+        return []
+    names = names.decode('utf-8').split('\n')
+    lens = array('q')
+    lens.frombytes(lengths)
+    residues = residues.decode('utf-8')
+    starts = itertools.accumulate(lens, initial=0)
+    seqs = [Sequence(name, residues[start:start+length]) for name, start, length in zip(names, starts, lens)]
+    if stats:
+        counts = array('q')
+        counts.frombytes(stats)
+        for seq, nongaps, gaps in zip(seqs, counts[:len(seqs)], counts[len(seqs):]):
+            seq._nongaps, seq._gaps = nongaps, gaps
     return seqs
+def _new_record(name, sequence, as_tuples):
+    if as_tuples:
+        return (name, sequence)
+    return Sequence(name, sequence)
 
 
 # # #  Module constants
 whitespace_name_filter = {ord(' '):'_', ord('\t'):'_', ord('\n'):'_'}
+ascii_letters = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+compression_magic = {b'\x1f\x8b':'gz', b'BZh':'bz2', b'\xfd7zXZ\x00':'xz'}
+compression_openers = {'gz':gzip.open, 'bz2':bz2.open, 'xz':lzma.open}
 # Restricted characters for phylogenetic software. Use: name.translate(phylo_name_filter)
 phylo_name_filter = {ord(' '):'_', ord('\t'):'_', ord('\n'):'_', ord(','):'_', ord(':'):'_', ord('('):None, ord(')'):None, ord('['):None, ord(']'):None, ord('<'):None, ord('>'):None, ord(';'):None, ord('='):None}
 
@@ -196,6 +482,7 @@ phylo_name_filter = {ord(' '):'_', ord('\t'):'_', ord('\n'):'_', ord(','):'_', o
 # # #  Module classes
 class SeqList(UserList):
     """
+    Sequences are indexed by name as they're added, removed, and renamed, so get() never scans the list. Where several sequences share a name, get() returns the one added most recently (a renamed sequence counts as added when the rename is noticed), and get_all() returns every one of them.
     The manipulation functions return self, allowing them to be chained."""
     def __init__(self, sequences=[], **kwargs):
         super().__init__()
@@ -205,33 +492,58 @@ class SeqList(UserList):
         # self.nongaps = int # Read-only property; sum of all alpha characters in sequences.
         # self.gaps = int # Read-only property; sum of all `-` characters in sequences.
         # self.is_alignment = Boolean # Read-only property; checks that all lengths are equal.
-        # self.lengths = List # Read-only property; returns a list of all sequence nongap lengths in order.
+        # self.lengths = List # Read-only property; returns a list of all sequence nongap lengths in order. Cached until the list or one of its sequences is modified.
         # #  Private attributes
-        self.names_cache = {} # Reset when SeqList changes, or when a child Sequence name is changed
-        self.self_ref = weakref.ref(self) # Used by Sequence children
+        self.names_index = {} # {name: Sequence}, or {name: [Sequences in the order they were added]} for a name held more than once. Saves a list per sequence
+        self.names_version = Sequence.name_version # The renames up to this Sequence.name_version are reflected in `names_index`
+        self.stats_cache = {} # Aggregate statistics of the sequences, updated as they are added and removed. 'lengths' is only present while that list is cached
+        self.stats_version = -1 # The value of Sequence.seq_version when `stats_cache` was last checked; it's recomputed if any of these Sequences has been modified since
+        self.trackers = [] # Objects like align.ColumnProfile with add_sequence() and remove_sequence() methods, notified of membership changes
         # #  Finish initialization
         for seq in sequences:
             self.append(seq)
 
     # # #  Accession and filtering
     def get(self, name, not_found=None):
-        """Returns the most recently added Sequence object with that name. If not found, returns the `not_found` value. Builds a cache just-in-time if needed."""
-        if not self.names_cache:
-            self.rebuild_cache()
-        return self.names_cache.get(name, not_found)
+        """Returns the most recently added Sequence object with that name. If not found, returns the `not_found` value."""
+        self._sync_names()
+        hit = self.names_index.get(name)
+        if hit is None:
+            return not_found
+        return hit[-1] if type(hit) is list else hit
+    def get_all(self, name):
+        """Returns a new SeqList of every Sequence with that name, in the order they were added."""
+        self._sync_names()
+        hit = self.names_index.get(name)
+        if hit is None:
+            return SeqList()
+        return SeqList(sequences=hit if type(hit) is list else [hit])
     def get_named(self, names):
-        """Returns a new SeqList of all sequences identified with a name in the collection `names`, respecting the order of `names` if applicable. Unfound names are ignored."""
-        if not self.names_cache:
-            self.rebuild_cache()
-        hits = [self.names_cache[name] for name in names if name in self.names_cache]
-        return SeqList(sequences=hits)
+        """Returns a new SeqList of the most recently added sequence for each name in the collection `names`, respecting the order of `names` if applicable. Unfound names are ignored."""
+        hits = [self.get(name) for name in names]
+        return SeqList(sequences=[hit for hit in hits if hit is not None])
     def get_where(self, selector):
         """Returns a new SeqList where the function `selector(seqobj)` evaluates to True."""
-        matches = SeqList()
+        return self.filter_where(selector)
+    def filter_where(self, predicate):
+        """Returns a new SeqList of the sequences where `predicate(seqobj)` evaluates to True, in one pass. self is not modified."""
+        return SeqList([seq for seq in self.data if predicate(seq)])
+    def remove_where(self, predicate, return_removed=False):
+        """Removes all sequences where `predicate(seqobj)` evaluates to True, calling it once for each sequence in order. The list is rebuilt once, instead of a remove() for each sequence. If `return_removed` is True, returns a SeqList of the removed Sequences."""
+        kept, removed = [], []
         for seq in self.data:
-            if selector(seq):
-                matches.append(seq)
-        return matches
+            if predicate(seq):
+                removed.append(seq)
+            else:
+                kept.append(seq)
+        if removed:
+            self._sync_names() # The predicate may have renamed sequences
+            self.data[:] = kept
+            self._deregister_seqs(removed)
+        if return_removed:
+            return SeqList(removed)
+        else:
+            return self
     def copy(self):
         """Returns a deepcopy of self."""
         seqs = SeqList()
@@ -239,10 +551,21 @@ class SeqList(UserList):
             seqs.append(seq.copy())
         return seqs
     def rebuild_cache(self):
-        cache = {}
-        for seq in self.data:
-            _ = cache.setdefault(seq.name, seq) # Does not overwrite repeated names
-        self.names_cache = cache
+        """Regroups the name index by the current names. Sequences whose names are unchanged keep their order; renamed ones are added after them, in list order. Only needed when renames have dropped out of Sequence.rename_journal."""
+        old_index, moved = self.names_index, []
+        self.names_index = {}
+        for name, hit in old_index.items():
+            for seq in (hit if type(hit) is list else (hit,)):
+                if seq.name == name:
+                    self._index(seq, name)
+                else:
+                    moved.append(seq)
+        if moved:
+            order = {id(seq):ind for ind, seq in enumerate(self.data)}
+            moved.sort(key=lambda seq: order.get(id(seq), len(order)))
+        for seq in moved:
+            self._index(seq, seq.name)
+        self.names_version = Sequence.name_version
 
     # #  Sequence manipulations
     def clean(self, allowed={'-'}):
@@ -262,44 +585,32 @@ class SeqList(UserList):
         return self
     def make_unique(self, return_removed=False):
         """Removes any children with identical sequences, keeping only the first object encountered. If `return_removed` is True, returns a SeqList of the removed Sequences."""
-        seqset, removed = set(), []
-        for seq in self.data[::]:
+        seqset = set()
+        def is_repeat(seq):
             if seq.seq in seqset:
-                removed.append(seq)
-                self.remove(seq)
-            else:
-                seqset.add(seq.seq)
-        if return_removed:
-            return SeqList(removed)
+                return True
+            seqset.add(seq.seq)
+            return False
+        return self.remove_where(is_repeat, return_removed=return_removed)
+    def filter_by_identity(self, threshold, return_clusters=False):
+        """Returns a new SeqList of representative sequences, such that no other sequence is >= `threshold` percent identical to its representative. The sequences must be aligned. Uses the greedy, CD-HIT-style align.identity_clusters(). If `return_clusters` is True, also returns a dict mapping the index of each sequence in self to the index of its representative, so repeated names are kept apart."""
+        from app_scripts.align import identity_clusters # Imported here as align is the higher-level module
+        rep_inds, assignments = identity_clusters(self.data, threshold)
+        reps = SeqList([self.data[ind] for ind in rep_inds])
+        if return_clusters:
+            membership = dict(enumerate(assignments))
+            return reps, membership
         else:
-            return self
+            return reps
     def remove_empty(self, return_removed=False):
         """Removes all sequences with no non-gap characters. If `return_removed` is True, returns a SeqList of the removed Sequences."""
         return self.remove_shorter(1, return_removed=return_removed)
     def remove_shorter(self, size, return_removed=False):
         """Removes all sequences with non-gap length < `size`. If `return_removed` is True, returns a SeqList of the removed Sequences."""
-        to_remove = []
-        for seq in self.data:
-            if seq.nongaps < size:
-                to_remove.append(seq)
-        for seq in to_remove:
-            self.remove(seq)
-        if return_removed:
-            return SeqList(to_remove)
-        else:
-            return self
+        return self.remove_where(lambda seq: seq.nongaps < size, return_removed=return_removed)
     def remove_longer(self, size, return_removed=False):
         """Removes all sequences with non-gap length > `size`. If `return_removed` is True, returns a SeqList of the removed Sequences."""
-        to_remove = []
-        for seq in self.data:
-            if seq.nongaps > size:
-                to_remove.append(seq)
-        for seq in to_remove:
-            self.remove(seq)
-        if return_removed:
-            return SeqList(to_remove)
-        else:
-            return self
+        return self.remove_where(lambda seq: seq.nongaps > size, return_removed=return_removed)
     def trim_to(self, start=None, end=None):
         """For all Sequences, keeps only the sequence between indices `start` and `end`."""
         for seq in self.data:
@@ -320,32 +631,35 @@ class SeqList(UserList):
     # #  Output formats
     def to_fasta(self, line=None, spaces=False, numbers=False):
         """line is an int indicating the length of each line. spaces and numbers are booleans."""
-        if line:
-            return '\n\n'.join(seq.to_fasta(line, spaces, numbers) for seq in self.data)
-        else:
-            return '\n\n'.join(str(seq) for seq in self.data)
+        buff = io.StringIO()
+        self.write_fasta(buff, line=line, spaces=spaces, numbers=numbers)
+        return buff.getvalue()
     def to_clustal(self, numbers=True, name_len=None):
         """Will not work if sequences have different lengths. If given, `name_len` should be an int indicating the max length of name to include. Does not check for uniqueness."""
-        strong = (set('STA'), set('NEQK'), set('NHQK'), set('NDEQ'), set('QHRK'),
-                  set('MILV'), set('MILF'), set('HY'), set('FYW'))
-        weak = (set('CSA'), set('ATV'), set('SAG'), set('STNK'), set('STPA'),
-                set('SGND'), set('SNDEQK'), set('NDEQHK'), set('NEQHRK'),
-                set('FVLIM'), set('HFY'))
-        def _conservation(col_tup):
-            col = set(col_tup)
-            if '-' in col: return ' '
-            if len(col) == 1: return '*'
-            for aas in strong:
-                if col <= aas: return ':'
-            for aas in weak:
-                if col <= aas: return '.'
+        buff = io.StringIO()
+        self.write_clustal(buff, numbers=numbers, name_len=name_len)
+        return buff.getvalue()
+    def to_phylip(self, kind='interleaved', strict=False, per_line=70, chunk_size=10):
+        """If given, `name_len` should be an int indicating the max length of name to include. Does not check for uniqueness. `line` indicates approximately how long to make each line."""
+        buff = io.StringIO()
+        self.write_phylip(buff, kind=kind, strict=strict, per_line=per_line, chunk_size=chunk_size)
+        return buff.getvalue()
+    def write_fasta(self, f, line=None, spaces=False, numbers=False):
+        """Writes the to_fasta() output to the file object `f` one sequence at a time."""
+        for ind, seq in enumerate(self.data):
+            if ind:
+                f.write('\n\n')
+            if line:
+                f.write(seq.to_fasta(line, spaces, numbers))
             else:
-                return ' '
-        names, sequences, seq_nums, seq_lens = [], [], {}, set()
+                f.write(str(seq))
+    def write_clustal(self, f, numbers=True, name_len=None):
+        """Writes the to_clustal() output to the file object `f` one block of 60 columns at a time, computing the conservation line and residue numbers for each block as it goes."""
+        from app_scripts.align import ColumnProfile # Imported here as align is the higher-level module
+        names, seq_nums, seq_lens = [], {}, set()
         for seq in self.data:
             name = seq.name.translate(whitespace_name_filter)[:name_len]
             names.append(name)
-            sequences.append(seq.seq.upper())
             seq_nums[name] = 0
             seq_lens.add(len(seq))
         if len(seq_lens) != 1:
@@ -354,50 +668,51 @@ class SeqList(UserList):
         max_name = max(len(name) for name in names)
         name_fmt = '{{:<{}}}'.format(max_name)
         cons_pref = ' ' * max_name
-        conserv = ''.join(_conservation(col) for col in zip(*sequences))
-        buff = ['CLUSTAL W multiple sequence alignment', '\n']
+        f.write('CLUSTAL W multiple sequence alignment\n\n')
         start_ind = 0
         for end_ind in range(60, seq_len+60, 60):
-            for name, sequence in zip(names, sequences):
-                line_buff = [name_fmt.format(name)]
-                seq = sequence[start_ind:end_ind]
-                line_buff.append(seq)
+            block = [seq[start_ind:end_ind].upper() for seq in self.data]
+            buff = []
+            for name, seq in zip(names, block):
+                line_buff = [name_fmt.format(name), seq]
                 if numbers:
                     num_chars = len(list(filter(str.isalpha, seq)))
                     seq_nums[name] += num_chars
                     line_buff.append(str(seq_nums[name]))
                 buff.append(' '.join(line_buff))
-            buff.append('{} {}'.format(cons_pref, conserv[start_ind:end_ind]))
+            buff.append('{} {}'.format(cons_pref, ColumnProfile(block).conservation()))
             buff.append('')
+            f.write('\n')
+            f.write('\n'.join(buff))
             start_ind = end_ind
-        return '\n'.join(buff)
-    def to_phylip(self, kind='interleaved', strict=False, per_line=70, chunk_size=10):
-        """If given, `name_len` should be an int indicating the max length of name to include. Does not check for uniqueness. `line` indicates approximately how long to make each line."""
+    def write_phylip(self, f, kind='interleaved', strict=False, per_line=70, chunk_size=10):
+        """Writes the to_phylip() output to the file object `f` one sequence at a time."""
         # if strict=True, seq names are limited to 10 characters, and edits seq names to be compatible with phylogenetic software, so removes/replaces: ` ()[]<>,:;=`
 
         per_line = 32
         #chunk_size = 7
 
-        names, aln_seqs, aln_lens = [], [], set()
+        names, aln_lens = [], set()
         for seq in self.data:
             if strict:
                 name = '{:10s}'.format(seq.name.translate(phylo_name_filter)[:10])
             else:
                 name = seq.name.translate(whitespace_name_filter)
             names.append(name)
-            aln_seq = ''.join(seq.seq.split())
-            aln_seqs.append(aln_seq)
-            aln_lens.add(len(aln_seq))
+            aln_lens.add(len(''.join(seq.seq.split())))
         if len(aln_lens) != 1:
             raise MolecbioInvalidAlignmentError("cannot save as a Phylip alignment as sequences have different lengths.")
         aln_len = aln_lens.pop()
         max_name = max(len(name) for name in names)
-        buff = ['   {}  {}'.format(len(self), aln_len)]
+        if kind not in ('interleaved', 'sequential'):
+            raise ValueError("unrecognized `kind` argument '{}'. It must be one of: 'interleaved', 'i', 'sequential', or 's'.".format(kind))
+        f.write('   {}  {}'.format(len(self), aln_len))
         if kind == 'interleaved':
             pass
         elif kind == 'sequential':
-            for name, seq in zip(names, aln_seqs):
-                line_buff, line_count = [], 0
+            for name, seq in zip(names, self.data):
+                seq = ''.join(seq.seq.split())
+                buff, line_buff, line_count = [], [], 0
                 for start in range(0, aln_len, chunk_size):
                     seq_str = seq[start:start+chunk_size]
                     if start == 0:
@@ -417,29 +732,50 @@ class SeqList(UserList):
                         line_buff, line_count = [], 0
                 if line_buff:
                     buff.append(' '.join(line_buff))
-        else:
-            raise ValueError("unrecognized `kind` argument '{}'. It must be one of: 'interleaved', 'i', 'sequential', or 's'.".format(kind))
-        return '\n'.join(buff)
+                if buff:
+                    f.write('\n')
+                    f.write('\n'.join(buff))
 
     # #  Dunder / built-in implementations
+    # The mutators sync the name index before changing self.data, so that a rebuild never sees a half-applied change.
     def append(self, seqobj):
+        self._sync_names()
         self.data.append(seqobj)
         self._register_seq(seqobj)
     def insert(self, index, seqobj):
+        self._sync_names()
         self.data.insert(index, seqobj)
         self._register_seq(seqobj)
     def extend(self, new_seqs):
         for seq in new_seqs:
-            self.data.append(seq)
-            self._register_seq(seq)
+            self.append(seq)
+    def sort(self, *args, **kwargs):
+        self.data.sort(*args, **kwargs)
+        self.stats_cache.pop('lengths', None)
+    def reverse(self):
+        self.data.reverse()
+        self.stats_cache.pop('lengths', None)
     def pop(self, index=-1):
+        self._sync_names()
         seq = self.data.pop(index)
         self._deregister_seq(seq)
         return seq
     def remove(self, seqobj):
-        self.data.remove(seqobj)
-        self._deregister_seq(seqobj)
+        # Removes seqobj itself if present, not just the first Sequence equal to it, so the name index stays correct.
+        self._sync_names()
+        for ind, seq in enumerate(self.data):
+            if seq is seqobj:
+                break
+        else:
+            ind = self.data.index(seqobj) # Raises ValueError if nothing is equal either, like list.remove()
+        self._deregister_seq(self.data.pop(ind))
+    def clear(self):
+        self._sync_names()
+        removed = self.data[:]
+        self.data.clear()
+        self._deregister_seqs(removed)
     def __setitem__(self, index, seqobj):
+        self._sync_names()
         if isinstance(index, slice):
             for ind, newseq in zip(range(*index.indices(len(self))), seqobj):
                 self._deregister_seq(self.data[ind])
@@ -450,6 +786,7 @@ class SeqList(UserList):
             self._register_seq(seqobj)
             self.data[index] = seqobj
     def __delitem__(self, index):
+        self._sync_names()
         if isinstance(index, slice):
             for ind in range(*index.indices(len(self))):
                 self._deregister_seq(self.data[ind])
@@ -491,9 +828,6 @@ class SeqList(UserList):
             for seq in self.data * (num-1):
                 self.append(seq)
             return self
-    def __del__(self):
-        for seq in self.data:
-            self._deregister_seq(seq)
     def __eq__(self, other):
         """Only valid comparison is to other SeqList objects."""
         if not isinstance(other, SeqList):
@@ -511,13 +845,101 @@ class SeqList(UserList):
 
     # #  Private methods
     def _register_seq(self, seqobj):
-        seqobj.parent_refs.append(self.self_ref)
-        if self.names_cache:
-            self.names_cache = {}
+        self._sync_names()
+        self._index(seqobj, seqobj.name)
+        self._update_stats((seqobj,), 1)
+        for tracker in self.trackers:
+            tracker.add_sequence(seqobj)
     def _deregister_seq(self, seqobj):
-        seqobj.parent_refs.remove(self.self_ref)
-        if self.names_cache:
-            self.names_cache = {}
+        self._sync_names()
+        self._unindex(id(seqobj), seqobj.name)
+        self._update_stats((seqobj,), -1)
+        for tracker in self.trackers:
+            tracker.remove_sequence(seqobj)
+    def _deregister_seqs(self, seqobjs):
+        # Batch version of _deregister_seq(), used by remove_where() and clear().
+        self._sync_names()
+        for seqobj in seqobjs:
+            self._unindex(id(seqobj), seqobj.name)
+        self._update_stats(seqobjs, -1)
+        for tracker in self.trackers:
+            for seqobj in seqobjs:
+                tracker.remove_sequence(seqobj)
+    def _sync_names(self):
+        # Replays the renames made since the index was last synced. Only the renamed Sequences held here are moved. The journal holds ids rather than the Sequences, so it doesn't keep them alive; as every index change is preceded by a sync, the index only holds Sequences that were alive when each pending rename was made, so an id can't match a different object.
+        version = Sequence.name_version
+        if self.names_version == version:
+            return
+        if self.names_version < Sequence.journal_start:
+            self.rebuild_cache()
+            return
+        index = self.names_index
+        for seq_id, old_name, new_name in Sequence.rename_journal[self.names_version - Sequence.journal_start:]:
+            if old_name == new_name or old_name not in index:
+                continue
+            seqobj = self._unindex(seq_id, old_name)
+            while seqobj is not None: # The same object may be held more than once
+                self._index(seqobj, new_name)
+                seqobj = self._unindex(seq_id, old_name)
+        self.names_version = version
+    def _index(self, seqobj, name):
+        hit = self.names_index.get(name)
+        if hit is None:
+            self.names_index[name] = seqobj
+        elif type(hit) is list:
+            hit.append(seqobj)
+        else:
+            self.names_index[name] = [hit, seqobj]
+    def _unindex(self, seq_id, name):
+        # Removes one occurrence of the Sequence whose id() is `seq_id` from the index under `name`, and returns it. Returns None if it wasn't found.
+        hit = self.names_index.get(name)
+        if hit is None:
+            return None
+        elif type(hit) is not list:
+            if id(hit) != seq_id:
+                return None
+            del self.names_index[name]
+            return hit
+        for ind in range(len(hit)-1, -1, -1):
+            if id(hit[ind]) == seq_id:
+                seqobj = hit.pop(ind)
+                if len(hit) == 1:
+                    self.names_index[name] = hit[0]
+                return seqobj
+        return None
+    def _stats_current(self, seqobjs=()):
+        # Returns whether `stats_cache` is up to date. Modifying a Sequence only makes it out of date if that Sequence is held here, or is in `seqobjs` being added or removed.
+        version = Sequence.seq_version
+        if self.stats_version == version:
+            return True
+        elif self.stats_version < 0:
+            return False
+        checked = self.stats_version
+        if any(seq._version > checked for seq in itertools.chain(self.data, seqobjs)):
+            self.stats_version = -1 # Stays out of date until recomputed, as changes made meanwhile aren't applied to it
+            return False
+        self.stats_version = version
+        return True
+    def _get_stats(self):
+        if not self._stats_current():
+            lens = [len(seq) for seq in self.data]
+            self.stats_cache = {'size':sum(lens), 'nongaps':sum(seq.nongaps for seq in self.data), 'gaps':sum(seq.gaps for seq in self.data), 'lens':Counter(lens)}
+            self.stats_version = Sequence.seq_version
+        return self.stats_cache
+    def _update_stats(self, seqobjs, delta):
+        # Only if the stats are current; otherwise they're recomputed when next needed.
+        if not self._stats_current(seqobjs):
+            return
+        stats = self.stats_cache
+        stats.pop('lengths', None)
+        for seqobj in seqobjs:
+            length = len(seqobj)
+            stats['size'] += delta * length
+            stats['nongaps'] += delta * seqobj.nongaps
+            stats['gaps'] += delta * seqobj.gaps
+            stats['lens'][length] += delta
+            if not stats['lens'][length]:
+                del stats['lens'][length]
 
     # #  Properties
     @property
@@ -525,35 +947,563 @@ class SeqList(UserList):
         return [seq.name for seq in self.data]
     @property
     def size(self):
-        return sum(len(seq.seq) for seq in self.data)
+        return self._get_stats()['size']
     @property
     def nongaps(self):
-        return sum(seq.nongaps for seq in self.data)
+        return self._get_stats()['nongaps']
     @property
     def gaps(self):
-        return sum(seq.gaps for seq in self.data)
+        return self._get_stats()['gaps']
     @property
     def is_alignment(self):
-        lens = {len(seq) for seq in self.data}
-        return len(lens) == 1
+        return len(self._get_stats()['lens']) == 1
     @property
     def lengths(self):
-        return [seq.nongaps for seq in self.data]
+        stats = self._get_stats()
+        if 'lengths' not in stats:
+            stats['lengths'] = [seq.nongaps for seq in self.data]
+        return list(stats['lengths']) # A copy, so the cached list can't be changed
+
+
+class SeqCache():
+    """
+    Binary cache of parsed sequence files, so that reloading a large alignment skips the text parsing. Each cache file holds the residues packed end to end (an N x L matrix for an alignment), the names, per-sequence lengths, nongaps and gaps, then a JSON header; putting the header last lets the file be written in one pass over the sequences, and puts the residues at a fixed offset so they can be memory-mapped by map(). It is keyed by the source path, size, mtime and a blake2b hash of its contents: a cache whose size and mtime match is used directly, one where only the mtime differs is used if the hash still matches, and anything else is reparsed."""
+    def __init__(self, cache_dir=None, max_size=1024*2**20):
+        # #  Public attributes
+        self.cache_dir = cache_dir # If None, each cache file is written next to its source file.
+        self.max_size = max_size # In bytes. Only enforced for a cache_dir, by deleting the least recently used files.
+        # #  Private attributes
+        self._magic = b'AKSEQCACHE2\n'
+        self._ext = '.akcache'
+        # #  Finish initialization
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # # #  Cache access
+    def load(self, filename, only_these=None):
+        """Returns a SeqList from the cache for `filename`, or None if there is no valid cache. If given, only sequences with names starting with one of the strings in `only_these` are returned."""
+        cache_path = self.cache_path(filename)
+        try:
+            info = os.stat(filename)
+            header, data = self._read(cache_path)
+        except (OSError, ValueError):
+            return None
+        if header['source'] != os.path.abspath(filename) or header['size'] != info.st_size:
+            return None
+        if header['mtime_ns'] != info.st_mtime_ns:
+            if header['hash'] != self.file_hash(filename):
+                return None
+            header['mtime_ns'] = info.st_mtime_ns # Contents are unchanged, so the cache is updated
+            seqs = self._unpack(header, data)
+            try:
+                self._write(cache_path, header, seqs)
+            except OSError:
+                pass # The cache is optional; it's refreshed on a later load if it can be
+        else:
+            seqs = self._unpack(header, data)
+            try:
+                os.utime(cache_path) # Marks it as recently used
+            except OSError:
+                pass
+        if only_these:
+            seqs = select_names(seqs, only_these)
+        return SeqList(seqs)
+    def map(self, filename, only_these=None):
+        """Returns a SeqList of MappedSequences, whose residues are read on demand from a memory map of the cache file for `filename` instead of being held in memory. Returns None if there is no cache with a matching size and mtime, or if the residues aren't all ASCII and so can't be addressed by character offsets. See load_mapped()."""
+        cache_path = self.cache_path(filename)
+        try:
+            info = os.stat(filename)
+            with open(cache_path, 'rb') as f:
+                header = self._read_header(f)
+                if header['source'] != os.path.abspath(filename) or header['size'] != info.st_size or header['mtime_ns'] != info.st_mtime_ns:
+                    return None
+                mapping = MappedSeqFile(cache_path, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), header, len(self._magic))
+        except (OSError, ValueError):
+            return None
+        if len(mapping.residues) != sum(mapping.lengths):
+            return None
+        try:
+            os.utime(cache_path) # Marks it as recently used
+        except OSError:
+            pass
+        only_these = name_selector(only_these)
+        return SeqList([mapping.sequence(ind) for ind, name in enumerate(mapping.names) if not only_these or only_these(name)])
+    def save(self, filename, seqs):
+        """Writes the cache for `filename` containing `seqs`, which can be any iterable of Sequences; they are written as they are iterated. Failures to write are ignored, as the cache is optional."""
+        info = os.stat(filename)
+        header = {'source':os.path.abspath(filename), 'size':info.st_size, 'mtime_ns':info.st_mtime_ns, 'hash':self.file_hash(filename)}
+        try:
+            self._write(self.cache_path(filename), header, seqs)
+        except OSError:
+            return
+        self.cleanup()
+    def remove(self, filename):
+        """Deletes the cache file for `filename`, if it exists."""
+        try:
+            os.remove(self.cache_path(filename))
+        except FileNotFoundError:
+            pass
+    def cleanup(self):
+        """Deletes the least recently used cache files until the cache_dir is no larger than max_size."""
+        if self.cache_dir is None:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self._ext) and entry.is_file():
+                info = entry.stat()
+                entries.append((info.st_mtime_ns, info.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+    def cache_path(self, filename):
+        filename = os.path.abspath(filename)
+        if self.cache_dir is None:
+            return filename + self._ext
+        path_hash = hashlib.blake2b(filename.encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, path_hash + self._ext)
+    @staticmethod
+    def file_hash(filename, block_size=2**20):
+        file_hash = hashlib.blake2b(digest_size=16)
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    # #  Private methods
+    def _write(self, cache_path, header, seqs):
+        names, lengths, nongaps, gaps = [], array('q'), array('q'), array('q')
+        residues_size = 0
+        tmp_path = cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self._magic)
+                for seq in seqs:
+                    residues = seq.seq.encode('utf-8')
+                    f.write(residues)
+                    residues_size += len(residues)
+                    names.append(seq.name)
+                    lengths.append(len(seq))
+                    nongaps.append(seq.nongaps)
+                    gaps.append(seq.gaps)
+                names = '\n'.join(names).encode('utf-8')
+                f.write(names)
+                lengths.tofile(f)
+                nongaps.tofile(f)
+                gaps.tofile(f)
+                header = dict(header, num_seqs=len(lengths), names_size=len(names), residues_size=residues_size, is_alignment=len(set(lengths)) == 1, byteorder=sys.byteorder)
+                header = json.dumps(header).encode('utf-8')
+                f.write(header)
+                f.write(struct.pack('<Q', len(header)))
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    def _read(self, cache_path):
+        """Returns the header dict and the body of the file, up to the header. Raises a ValueError if the file isn't a valid cache."""
+        with open(cache_path, 'rb') as f:
+            header = self._read_header(f)
+            return header, f.read(header['residues_size'] + header['names_size'] + 3 * 8 * header['num_seqs'])
+    def _read_header(self, f):
+        """Returns the header dict of the open cache file `f`, leaving it positioned at the start of the body. Raises a ValueError if the file isn't a valid cache."""
+        file_size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        if file_size < len(self._magic) + 8 or f.read(len(self._magic)) != self._magic:
+            raise ValueError("'{}' is not a sequence cache file.".format(f.name))
+        f.seek(file_size - 8)
+        header_size, = struct.unpack('<Q', f.read(8))
+        body_size = file_size - len(self._magic) - 8 - header_size
+        if body_size < 0:
+            raise ValueError("'{}' is not a valid sequence cache file.".format(f.name))
+        f.seek(len(self._magic) + body_size)
+        header = json.loads(f.read(header_size).decode('utf-8'))
+        expected = header['residues_size'] + header['names_size'] + 3 * 8 * header['num_seqs']
+        if header['byteorder'] != sys.byteorder or body_size != expected:
+            raise ValueError("'{}' is not a valid sequence cache file.".format(f.name))
+        f.seek(len(self._magic))
+        return header
+    def _unpack(self, header, data):
+        """Returns a list of Sequences from the body of a cache file."""
+        num_seqs, names_size, residues_size = header['num_seqs'], header['names_size'], header['residues_size']
+        names_end = residues_size + names_size
+        return _unpack_records(data[residues_size:names_end], data[names_end:names_end+8*num_seqs], data[:residues_size], data[names_end+8*num_seqs:])
+
+
+class MappedSeqFile():
+    """
+    A read-only memory map of a SeqCache file, shared by the MappedSequences made from it. Only the names and the per-sequence arrays are read into memory. The residues are addressed by character offsets, so must all be ASCII. The map is closed once this and all of its unmodified sequences have been deleted."""
+    def __init__(self, path, mm, header, offset):
+        # #  Public attributes
+        self.path = path
+        self.num_seqs = header['num_seqs']
+        self.aln_len = None # The length of every sequence, or None if they are not an alignment.
+        self.names = []
+        self.lengths = array('q')
+        self.residues = None # Read-only memoryview of all residues end to end, as ASCII bytes.
+        # #  Private attributes
+        self._mmap = mm
+        self._nongaps = array('q')
+        self._gaps = array('q')
+        self._starts = []
+        # #  Finish initialization
+        residues_end = offset + header['residues_size']
+        names_end = residues_end + header['names_size']
+        self.residues = memoryview(mm)[offset:residues_end]
+        if self.num_seqs:
+            self.names = mm[residues_end:names_end].decode('utf-8').split('\n')
+        for ind, values in enumerate((self.lengths, self._nongaps, self._gaps)):
+            start = names_end + 8 * self.num_seqs * ind
+            values.frombytes(mm[start:start+8*self.num_seqs])
+        self._starts = list(itertools.accumulate(self.lengths, initial=0))
+        if header['is_alignment']:
+            self.aln_len = self.lengths[0]
+    def sequence(self, ind):
+        """Returns a new MappedSequence for the sequence at index `ind` of the file."""
+        return MappedSequence(self.names[ind], self, ind, self._starts[ind], self.lengths[ind], self._nongaps[ind], self._gaps[ind])
+    def columns(self):
+        """Yields each column of the alignment as a string, read from the map with a strided slice. Requires aln_len to not be None."""
+        for ind in range(self.aln_len):
+            yield self.residues[ind::self.aln_len].tobytes().decode('ascii')
+
+class AlignmentMatrix():
+    """
+    An alignment held as one contiguous N x L matrix of ASCII codes with a name index, for column-wise work without a string per sequence. Made by from_seqs() or load_matrix(), and accepted by the functions in align. Offers the read API of a SeqList; indexing and iteration give MappedSequence views of the rows, each made once then kept. Rows and columns can also be taken without copying: with numpy, `array` is a read-only uint8 array of shape (N, L) and row() and column() return views of it; without numpy they return memoryviews of `residues`. The matrix itself is read-only, and assigning to a row's `seq` detaches that row from it.
+
+    Implements the following built-in methods: len(), iteration, indexing"""
+    def __init__(self, names, residues, aln_len):
+        # #  Public attributes
+        self.names = list(names) # In row order.
+        self.num_seqs = len(self.names)
+        self.aln_len = aln_len
+        self.residues = memoryview(residues).toreadonly() # All rows end to end, as ASCII bytes.
+        self.array = None # Read-only numpy view of `residues` with shape (num_seqs, aln_len), or None without numpy.
+        # self.size = int # Read-only property; total number of characters.
+        # self.nongaps = int # Read-only property; sum of all alpha characters in sequences.
+        # self.gaps = int # Read-only property; sum of all `-` characters in sequences.
+        # self.is_alignment = Boolean # Read-only property; True unless empty, as in SeqList.
+        # self.lengths = List # Read-only property; returns a list of all sequence nongap lengths in order.
+        # #  Private attributes
+        self._name_index = {name:ind for ind, name in enumerate(self.names)} # The last row wins, as in SeqList.get()
+        self._rows = [None] * self.num_seqs
+        # #  Finish initialization
+        if len(self.residues) != self.num_seqs * aln_len:
+            raise MolecbioInvalidAlignmentError("{} bytes of residues can't form {} rows of length {}.".format(len(self.residues), self.num_seqs, aln_len))
+        if np is not None:
+            self.array = np.frombuffer(self.residues, dtype=np.uint8).reshape(self.num_seqs, aln_len)
+    @classmethod
+    def from_seqs(cls, seqs):
+        """Returns a new AlignmentMatrix of `seqs`, a SeqList or list of Sequences. The residues of a whole memory-mapped alignment from load_mapped() are used without copying. Raises a MolecbioInvalidAlignmentError if the sequences are not all the same length or contain non-ASCII characters."""
+        names = [seq.name for seq in seqs]
+        mapped = mapped_rows(seqs)
+        if mapped is not None and mapped[1] == list(range(mapped[0].num_seqs)):
+            return cls(names, mapped[0].residues, mapped[0].aln_len)
+        seq_strs = [seq.seq for seq in seqs]
+        aln_len = len(seq_strs[0]) if seq_strs else 0
+        if any(len(seq) != aln_len for seq in seq_strs):
+            raise MolecbioInvalidAlignmentError("cannot make a matrix of sequences of different lengths. They should be aligned first.")
+        residues = ''.join(seq_strs)
+        if not residues.isascii():
+            raise MolecbioInvalidAlignmentError("cannot make a matrix of sequences containing non-ASCII characters.")
+        return cls(names, residues.encode('ascii'), aln_len)
+
+    # # #  Accession
+    def get(self, name, not_found=None):
+        """Returns the view of the last row with that name. If not found, returns the `not_found` value."""
+        ind = self._name_index.get(name)
+        if ind is None:
+            return not_found
+        return self[ind]
+    def get_named(self, names):
+        """Returns a new AlignmentMatrix of the rows identified with a name in the collection `names`, respecting the order of `names` if applicable. Unfound names are ignored."""
+        return self._take([self._name_index[name] for name in names if name in self._name_index])
+    def get_where(self, selector):
+        """Returns a new AlignmentMatrix of the rows where the function `selector(row)` evaluates to True."""
+        return self._take([ind for ind, row in enumerate(self) if selector(row)])
+    def row(self, ind):
+        """Returns row `ind` as a numpy view or memoryview, without copying."""
+        if self.array is not None:
+            return self.array[ind]
+        ind = range(self.num_seqs)[ind]
+        return self.residues[ind*self.aln_len:(ind+1)*self.aln_len]
+    def column(self, ind):
+        """Returns column `ind` as a numpy view or strided memoryview, without copying."""
+        if self.array is not None:
+            return self.array[:, ind]
+        return self.residues[range(self.aln_len)[ind]::self.aln_len]
+    def columns(self):
+        """Yields each column as a string."""
+        for ind in range(self.aln_len):
+            yield self.residues[ind::self.aln_len].tobytes().decode('ascii')
+    def to_seqlist(self):
+        """Returns a new SeqList of ordinary Sequences with the same names and residues."""
+        return SeqList([Sequence(name, self.residues[ind*self.aln_len:(ind+1)*self.aln_len].tobytes().decode('ascii')) for ind, name in enumerate(self.names)])
+
+    # # #  Dunder implementations
+    def __len__(self):
+        return self.num_seqs
+    def __iter__(self):
+        for ind in range(self.num_seqs):
+            yield self[ind]
+    def __getitem__(self, index):
+        """An int returns the view of that row; a slice returns a new AlignmentMatrix, sharing the residues if the step is 1."""
+        if isinstance(index, slice):
+            inds = range(self.num_seqs)[index]
+            if inds.step == 1:
+                return AlignmentMatrix(self.names[index], self.residues[inds.start*self.aln_len:inds.stop*self.aln_len], self.aln_len)
+            return self._take(inds)
+        row = self._rows[index]
+        if row is None:
+            ind = range(self.num_seqs)[index]
+            row = MappedSequence(self.names[ind], self, ind, ind*self.aln_len, self.aln_len, None, None)
+            self._rows[ind] = row
+        return row
+    def __repr__(self):
+        return '<AlignmentMatrix at {} of {} sequences by {} columns>'.format(hex(id(self)).upper(), self.num_seqs, self.aln_len)
+
+    # #  Private methods
+    def _take(self, inds):
+        if self.array is not None:
+            residues = self.array[list(inds)].tobytes()
+        else:
+            residues = b''.join(self.residues[ind*self.aln_len:(ind+1)*self.aln_len] for ind in inds)
+        return AlignmentMatrix([self.names[ind] for ind in inds], residues, self.aln_len)
+
+    # #  Properties
+    @property
+    def size(self):
+        return len(self.residues)
+    @property
+    def nongaps(self):
+        if self.array is not None:
+            return sum(self.lengths)
+        return len(self.residues) - len(self.residues.tobytes().translate(None, ascii_letters))
+    @property
+    def gaps(self):
+        if self.array is not None:
+            return int(np.count_nonzero(self.array == ord('-')))
+        return self.residues.tobytes().count(b'-')
+    @property
+    def is_alignment(self):
+        return self.num_seqs > 0
+    @property
+    def lengths(self):
+        if self.array is not None:
+            letters = np.zeros(256, dtype=bool)
+            letters[np.frombuffer(ascii_letters, dtype=np.uint8)] = True
+            return np.count_nonzero(letters[self.array], axis=1).tolist()
+        return [row.nongaps for row in self]
+
+
+class FastaIndex():
+    """
+    Random access to the sequences in a FASTA file, using a .fai index of each record's ID, length, offset, bases per line and bytes per line, as written by `samtools faidx`. The index is built in one streaming pass, written next to the file (or to `index_filename`), and reused until the FASTA file is modified; an existing index from samtools is used as is. As in samtools, the index names records by their ID, the first word of the header line. Sequences are returned with the full header line as their name, as from parse_fasta(), which is read from the FASTA file when needed. Every record is indexed, including those with repeated IDs. Every sequence line of a record except the last must have the same length."""
+    def __init__(self, filename, index_filename=None):
+        # #  Public attributes
+        self.filename = filename
+        self.index_filename = index_filename or filename + '.fai'
+        self.names = [] # Record IDs in file order, including repeated IDs.
+        self.records = [] # (length, offset, line_bases, line_width) of each record, matching `names`.
+        self.entries = {} # ID: index into `names`. The first record is used to fetch a repeated ID.
+        # #  Private attributes
+        self._headers = [] # The full header line of each record, matching `names`, or None until it is read.
+        # #  Finish initialization
+        if file_compression(filename):
+            raise MolecbioFileFormatError("'{}' is compressed, so can't be indexed. It must be decompressed first.".format(filename))
+        if not self.read_index():
+            self.build()
+
+    # # #  Sequence access
+    def fetch(self, name, start=None, end=None):
+        """Returns the Sequence with the ID `name`, optionally only the region [start:end] using Python slice semantics. If the ID is repeated, the first record with it is returned. Raises a KeyError if the ID is not in the index."""
+        with open(self.filename, 'rb') as f:
+            return self._fetch(f, self.entries[name], start, end)
+    def fetch_many(self, names):
+        """Returns a new SeqList of the sequences with the IDs in `names`, in that order, using the first record for a repeated ID. Unfound IDs are ignored."""
+        inds = [self.entries[name] for name in names if name in self.entries]
+        with open(self.filename, 'rb') as f:
+            return SeqList([self._fetch(f, ind) for ind in inds])
+    def select(self, only_these):
+        """Returns a new SeqList of the sequences with names starting with any of the strings in `only_these`, in file order. Every record with a selected name is returned, as from parse_fasta(). Only the header lines of records with a possible ID are read."""
+        only_these = name_selector(only_these)
+        # A name can only be selected if its ID starts with the first word of a requested name.
+        id_selector = NameSelector([(name.split(None, 1) or [''])[0] for name in only_these.names], exact=only_these.exact)
+        candidates = [ind for ind, name in enumerate(self.names) if id_selector(name)]
+        with open(self.filename, 'rb') as f:
+            return SeqList([self._fetch(f, ind) for ind in candidates if only_these(self._header(f, ind))])
+    def build(self):
+        """Indexes the FASTA file in one pass and writes the index file. Raises a MolecbioFileFormatError if a record's sequence lines are not all the same length."""
+        headers, records = [], []
+        record = None
+        with open(self.filename, 'rb') as f:
+            offset = 0
+            for line_num, line in enumerate(f, 1):
+                if line.startswith(b'>'):
+                    self._add_record(record, headers, records)
+                    header = line.decode('utf-8').strip()[1:] # As in parse_fasta()
+                    record = [header, 0, offset + len(line), 0, 0, False] # header, length, offset, line_bases, line_width, seen_last_line
+                    offset += len(line)
+                    continue
+                offset += len(line)
+                if record is None:
+                    continue # Lines before the first header are ignored
+                bases = line.rstrip(b'\r\n')
+                if bases != bases.strip():
+                    raise MolecbioFileFormatError("line {} of '{}' starts or ends with whitespace, so the file can't be indexed.".format(line_num, self.filename))
+                if not bases:
+                    record[5] = True # Blank lines may only follow the sequence
+                elif record[5] or (record[3] and len(bases) > record[3]):
+                    raise MolecbioFileFormatError("the sequence lines of '{}' in '{}' have different lengths, so the file can't be indexed.".format(record[0], self.filename))
+                elif record[3] == 0:
+                    record[3], record[4] = len(bases), len(line)
+                elif len(bases) < record[3]:
+                    record[5] = True # Only the last line may be shorter
+                elif len(line) != record[4] and line.endswith(b'\n'):
+                    raise MolecbioFileFormatError("the line endings of '{}' in '{}' are mixed, so the file can't be indexed.".format(record[0], self.filename))
+                record[1] += len(bases)
+        self._add_record(record, headers, records)
+        self._set_records([header.split(None, 1)[0] for header in headers], records, headers)
+        self.write_index()
+    def read_index(self):
+        """Loads the index file if it exists and is not older than the FASTA file. Returns True if it was loaded."""
+        try:
+            if os.path.getmtime(self.index_filename) < os.path.getmtime(self.filename):
+                return False
+            names, records = [], []
+            with open(self.index_filename, encoding='utf-8') as f:
+                for line in f:
+                    name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                    if name.split() != [name]:
+                        return False # Not an ID, so not written by samtools or this class
+                    names.append(name)
+                    records.append((int(length), int(offset), int(line_bases), int(line_width)))
+        except (OSError, ValueError):
+            return False
+        self._set_records(names, records, [None] * len(names))
+        return True
+    def write_index(self):
+        """Writes the index file. Failures to write are ignored, as the index is then just kept in memory."""
+        tmp_filename = self.index_filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w', encoding='utf-8') as f:
+                for name, record in zip(self.names, self.records):
+                    f.write('{}\t{}\t{}\t{}\t{}\n'.format(name, *record))
+            os.replace(tmp_filename, self.index_filename)
+        except OSError:
+            pass
+
+    # #  Private methods
+    def _fetch(self, f, ind, start=None, end=None):
+        name = self._header(f, ind)
+        length, offset, line_bases, line_width = self.records[ind]
+        start, end, _ = slice(start, end).indices(length)
+        if end <= start:
+            return Sequence(name, '')
+        start_byte = offset + start // line_bases * line_width + start % line_bases
+        end_byte = offset + (end - 1) // line_bases * line_width + (end - 1) % line_bases + 1
+        f.seek(start_byte)
+        data = f.read(end_byte - start_byte)
+        return Sequence(name, data.replace(b'\r', b'').replace(b'\n', b'').decode('utf-8'))
+    def _header(self, f, ind):
+        """Returns the full header line of the record, reading it from the end of the line before its offset."""
+        if self._headers[ind] is None:
+            offset = self.records[ind][1]
+            chunk_size = 256
+            while True:
+                chunk_start = max(0, offset - chunk_size)
+                f.seek(chunk_start)
+                data = f.read(offset - chunk_start)
+                line_start = data.rfind(b'\n>', 0, len(data) - 1) + 1
+                if line_start or chunk_start == 0:
+                    break
+                chunk_size *= 4
+            self._headers[ind] = data[line_start:].decode('utf-8').strip()[1:]
+        return self._headers[ind]
+    def _set_records(self, names, records, headers):
+        entries = {}
+        for ind, name in enumerate(names):
+            _ = entries.setdefault(name, ind) # Does not overwrite repeated IDs
+        self.names, self.records, self.entries, self._headers = names, records, entries, headers
+    @staticmethod
+    def _add_record(record, headers, records):
+        if record is None or not record[0]:
+            return # Records without names are skipped, as in parse_fasta()
+        header, length, offset, line_bases, line_width, _ = record
+        headers.append(header)
+        records.append((length, offset, line_bases, line_width))
+
+
+class NameSelector():
+    """
+    Selects names starting with any of the given prefixes, or equal to one of the given names if `exact` is True, and records which of them were found. Can be passed as `only_these` to any of the load, parse, or iter functions; a plain collection of strings is converted to one. The prefixes are kept in a set and bucketed by length, so each name is checked with one lookup per distinct prefix length however many prefixes there are.
+
+    Implements the following built-in methods: len(), and calling with a name to return whether it is selected."""
+    def __init__(self, names, exact=False):
+        # #  Public attributes
+        self.names = list(dict.fromkeys(names)) # The requested names or prefixes, in the given order.
+        self.exact = exact
+        # #  Private attributes
+        self._names = set(self.names)
+        self._lengths = sorted(set(len(name) for name in self.names))
+        self._found = set()
+    def not_found(self):
+        """Returns the requested names or prefixes that haven't matched any name so far, in the given order."""
+        return [name for name in self.names if name not in self._found]
+    def reset(self):
+        """Forgets which names have been found."""
+        self._found.clear()
+    def __call__(self, name):
+        if self.exact:
+            if name in self._names:
+                self._found.add(name)
+                return True
+            return False
+        selected = False
+        for length in self._lengths:
+            if length > len(name):
+                break
+            prefix = name[:length]
+            if prefix in self._names:
+                self._found.add(prefix)
+                selected = True
+        return selected
+    def __len__(self):
+        return len(self.names)
+    def __repr__(self):
+        return 'NameSelector({} {}, {} found)'.format(len(self.names), 'names' if self.exact else 'prefixes', len(self._found))
 
 
 class Sequence():
     """
+    Uses __slots__ to keep the per-object overhead small, as there may be hundreds of thousands of them. Sequences don't track the SeqLists holding them; instead, renaming any Sequence appends its id() and names to the class attribute `rename_journal` and increments `name_version`, and assigning to any `seq` increments `seq_version` and stamps that Sequence with it. Each SeqList replays the journal to keep its name index current; if `seq_version` has changed, it recomputes its statistics when it next needs them only if one of its own Sequences has a newer stamp.
 
     Implements the following built-in methods: len()"""
+    __slots__ = ('_seq', '_name', '_nongaps', '_gaps', '_version')
+    name_version = 0 # Incremented whenever any Sequence is renamed; the total number of renames so far
+    rename_journal = [] # (id(Sequence), old name, new name) of the most recent renames; ids, so renamed Sequences can still be freed. Entry i is rename number `journal_start + i`
+    journal_start = 0 # The name_version of the oldest rename still in `rename_journal`
+    max_journal = 4096 # When the journal grows past this, the oldest half is dropped. SeqLists that missed those renames rebuild their index instead
+    seq_version = 0 # Incremented whenever any Sequence's `seq` is assigned; the new value is stored in that Sequence's `_version`
     def __init__(self, name='', sequence=''):
         # #  Public attributes
-        self.seq = sequence # Also available as Sequence.sequence
+        # self.seq = str # Property; also available as Sequence.sequence.
         # self.name = str # Property
-        # self.nongaps = int # Read-only property; sum of all alpha characters.
-        # self.gaps = int # Read-only property; sum of all `-` characters.
+        # self.nongaps = int # Read-only property; sum of all alpha characters. Cached until `seq` is assigned.
+        # self.gaps = int # Read-only property; sum of all `-` characters. Cached until `seq` is assigned.
         # #  Private attributes
+        self._seq = sequence
         self._name = name
-        self.parent_refs = [] # The SeqList objects that are holding self
+        self._version = 0 # The seq_version when `seq` was last assigned
+        self._nongaps = None
+        self._gaps = None
     # #  Sequence manipulations
     def strip_gaps(self):
         """Removes all gap characters in the sequence."""
@@ -596,13 +1546,13 @@ class Sequence():
             return str(self)
         else:
             if numbers:
-                num_max = len(self.seq) // line * line
+                num_max = len(self) // line * line
                 num_len = len(str(num_max))
                 num_fmt = '{{:>{}}}'.format(num_len)
             buff = []
             start_ind = 0
             for end_ind in range(line, len(self)+line, line):
-                seq_line = self.seq[start_ind:end_ind]
+                seq_line = self[start_ind:end_ind]
                 line_buff = []
                 if numbers:
                     line_buff.append(num_fmt.format(start_ind+1))
@@ -641,6 +1591,17 @@ class Sequence():
         return other in self.seq
     # #  Properties
     @property
+    def seq(self):
+        return self._seq
+    @seq.setter
+    def seq(self, value):
+        # Clears the cached counts, and lets the SeqLists holding this Sequence know that their statistics are out of date.
+        self._seq = value
+        self._nongaps = None
+        self._gaps = None
+        Sequence.seq_version += 1
+        self._version = Sequence.seq_version
+    @property
     def sequence(self):
         return self.seq
     @sequence.setter
@@ -651,19 +1612,86 @@ class Sequence():
         return self._name
     @name.setter
     def name(self, new_name):
-        # Updates all containing SeqLists that `name` has changed.
+        # Records the rename, so SeqLists can move this Sequence in their name indices.
+        old_name = self._name
         self._name = new_name
-        for p_ref in self.parent_refs:
-            parent = p_ref() # weakref
-            if parent is not None and parent.names_cache:
-                parent.names_cache = {}
+        journal = Sequence.rename_journal
+        journal.append((id(self), old_name, new_name))
+        Sequence.name_version += 1
+        if len(journal) > Sequence.max_journal:
+            drop = len(journal) // 2
+            del journal[:drop]
+            Sequence.journal_start += drop
     @property
     def nongaps(self):
         # Does not validate characters, just counts all alphabetic characters.
-        return len(list(filter(str.isalpha, self.seq)))
+        if self._nongaps is None:
+            if self._seq.isascii():
+                self._nongaps = len(self._seq) - len(self._seq.encode('ascii').translate(None, ascii_letters))
+            else:
+                self._nongaps = sum(map(str.isalpha, self._seq))
+        return self._nongaps
+    @property
+    def gaps(self):
+        if self._gaps is None:
+            self._gaps = self._seq.count('-')
+        return self._gaps
+
+class MappedSequence(Sequence):
+    """
+    A Sequence whose residues are read on demand from a MappedSeqFile or AlignmentMatrix instead of being held as a string; made by load_mapped(), SeqCache.map(), and by indexing an AlignmentMatrix. len(), indexing, nongaps and gaps are answered from the shared buffer without building the whole sequence. Assigning to `seq`, as all of the sequence manipulations do, replaces the mapped residues with an ordinary string."""
+    __slots__ = ('mapping', 'row', '_start', '_length')
+    def __init__(self, name, mapping, row, start, length, nongaps, gaps):
+        # #  Public attributes
+        self.mapping = mapping # The MappedSeqFile or AlignmentMatrix holding the residues, or None once `seq` has been assigned.
+        self.row = row # The index of the sequence in `mapping`.
+        # self.view = memoryview # Read-only property; the mapped residues, or None once `seq` has been assigned.
+        # #  Private attributes
+        self._name = name
+        self._seq = None
+        self._start = start
+        self._length = length
+        self._nongaps = nongaps # Counted when first needed if None
+        self._gaps = gaps
+        self._version = 0
+    def __len__(self):
+        if self.mapping is None:
+            return len(self._seq)
+        return self._length
+    def __getitem__(self, index):
+        if self.mapping is None:
+            return self._seq[index]
+        if isinstance(index, slice):
+            return self.view[index].tobytes().decode('ascii')
+        return chr(self.view[index])
+    @property
+    def view(self):
+        if self.mapping is None:
+            return None
+        return self.mapping.residues[self._start:self._start+self._length]
+    @property
+    def seq(self):
+        if self.mapping is None:
+            return self._seq
+        return str(self.view, 'ascii')
+    @seq.setter
+    def seq(self, value):
+        Sequence.seq.fset(self, value)
+        self.mapping = None
+    @property
+    def nongaps(self):
+        if self.mapping is None:
+            return Sequence.nongaps.fget(self)
+        if self._nongaps is None:
+            self._nongaps = self._length - len(self.view.tobytes().translate(None, ascii_letters))
+        return self._nongaps
     @property
     def gaps(self):
-        return self.seq.count('-')
+        if self.mapping is None:
+            return Sequence.gaps.fget(self)
+        if self._gaps is None:
+            self._gaps = self.view.tobytes().count(b'-')
+        return self._gaps
 
 
 # # #  Errors
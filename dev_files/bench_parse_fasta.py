@@ -0,0 +1,70 @@
+"""
+Benchmarks parse_fasta() on test_dir/lenient_old.aln and on a synthetic FASTA file. With --workers, parse_fasta_parallel() is timed as well and checked to give identical results.
+Run from the repository root: python dev_files/bench_parse_fasta.py [--size-mb 300] [--line-len 60] [--workers 4]
+"""
+# Author: Dave Curran
+# Date: Aug 2022
+
+import os, sys, time, random, argparse, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app_scripts import sequ
+
+
+def time_parsers(filename, repeats, workers=None):
+    if workers:
+        with open(filename) as f:
+            text_seqs = sequ.parse_fasta(f)
+        if [(s.name, s.seq) for s in sequ.parse_fasta_parallel(filename, workers=workers)] != [(s.name, s.seq) for s in text_seqs]:
+            raise RuntimeError("parse_fasta_parallel() and parse_fasta() disagree on '{}'".format(filename))
+        del text_seqs
+    text_time, par_time = [], []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        with open(filename) as f:
+            seqs = sequ.parse_fasta(f)
+        text_time.append(time.perf_counter() - t0)
+        num_seqs = len(seqs)
+        del seqs
+        if workers:
+            t0 = time.perf_counter()
+            seqs = sequ.parse_fasta_parallel(filename, workers=workers)
+            par_time.append(time.perf_counter() - t0)
+            del seqs
+    text_time = min(text_time)
+    size_mb = os.path.getsize(filename) / 2**20
+    print('{}: {:.1f} MB, {} sequences'.format(os.path.basename(filename), size_mb, num_seqs))
+    print('  parse_fasta       {:8.3f} s  {:7.1f} MB/s'.format(text_time, size_mb / text_time))
+    if workers:
+        par_time = min(par_time)
+        print('  parse_fasta_parallel ({} workers) {:8.3f} s  {:7.1f} MB/s  ({:.1f}x)'.format(workers, par_time, size_mb / par_time, text_time / par_time))
+def write_synthetic_fasta(filename, size_mb, line_len, seed=0):
+    """Writes random aligned protein records with wrapped sequence lines until the file reaches roughly `size_mb`."""
+    rng = random.Random(seed)
+    residues = 'ACDEFGHIKLMNPQRSTVWY-'
+    aln_len = 600
+    record_lines = [''.join(rng.choices(residues, k=aln_len)) for i in range(64)] # A pool of sequences, reused to keep generation fast
+    target = int(size_mb * 2**20)
+    written, ind = 0, 0
+    with open(filename, 'w') as f:
+        while written < target:
+            seq = record_lines[ind % len(record_lines)]
+            lines = [seq[i:i+line_len] for i in range(0, aln_len, line_len)]
+            record = '>seq_{} synthetic record {}\n{}\n'.format(ind, ind % 97, '\n'.join(lines))
+            f.write(record)
+            written += len(record)
+            ind += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark FASTA parsing.')
+    parser.add_argument('--size-mb', type=float, default=300, help='size of the synthetic FASTA file in MB (default 300)')
+    parser.add_argument('--line-len', type=int, default=60, help='sequence line length of the synthetic file (default 60)')
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed repeats; the best is reported (default 3)')
+    parser.add_argument('--workers', type=int, default=None, help='also time parse_fasta_parallel() with this many processes')
+    args = parser.parse_args()
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    time_parsers(os.path.join(repo_dir, 'test_dir', 'lenient_old.aln'), args.repeats, args.workers)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synth_file = os.path.join(tmp_dir, 'synthetic.fasta')
+        write_synthetic_fasta(synth_file, args.size_mb, args.line_len)
+        time_parsers(synth_file, args.repeats, args.workers)
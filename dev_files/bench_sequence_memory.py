@@ -0,0 +1,66 @@
+"""
+Measures the memory used per Sequence held in a SeqList, on a synthetic set of 262,144 sequences. The residue strings are made first and shared by every layout, so only the per-object overhead is compared. The layout before Sequence used __slots__ (a __dict__, plus a `parent_refs` list holding a weakref for each containing SeqList) is rebuilt here as LegacySequence for the comparison.
+Run from the repository root: python dev_files/bench_sequence_memory.py [--num-seqs 262144] [--seq-len 300]
+"""
+# Author: Dave Curran
+# Date: Aug 2022
+
+import os, sys, gc, random, argparse, tracemalloc, weakref
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app_scripts import sequ
+
+
+class LegacySequence():
+    """The per-object layout of Sequence before __slots__."""
+    def __init__(self, name='', sequence=''):
+        self.seq = sequence
+        self._name = name
+        self.parent_refs = []
+class LegacySeqList(list):
+    """Only adds the weakref bookkeeping that SeqList used to do for each appended Sequence."""
+    def __init__(self, sequences):
+        super().__init__()
+        self.self_ref = weakref.ref(self)
+        for seq in sequences:
+            self.append(seq)
+            seq.parent_refs.append(self.self_ref)
+
+def measure(build, names, seq_strs):
+    """Returns the bytes allocated by `build(names, seq_strs)`, and the peak, measured while the result is still alive."""
+    gc.collect()
+    tracemalloc.start()
+    result = build(names, seq_strs)
+    used, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return used, peak
+def build_legacy(names, seq_strs):
+    return LegacySeqList(LegacySequence(name, seq) for name, seq in zip(names, seq_strs))
+def build_current(names, seq_strs):
+    return sequ.SeqList([sequ.Sequence(name, seq) for name, seq in zip(names, seq_strs)])
+def synthetic_seqs(num_seqs, seq_len, seed=0):
+    """Returns lists of names and of distinct random residue strings."""
+    rng = random.Random(seed)
+    residues = 'ACDEFGHIKLMNPQRSTVWY-'
+    pool = ''.join(rng.choices(residues, k=seq_len*64 + num_seqs)) # Offset slices of a pool give distinct strings quickly
+    names = ['seq_{}'.format(ind) for ind in range(num_seqs)]
+    seq_strs = [pool[ind:ind+seq_len] for ind in range(num_seqs)]
+    return names, seq_strs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the memory used per Sequence.')
+    parser.add_argument('--num-seqs', type=int, default=262144, help='number of synthetic sequences (default 262144)')
+    parser.add_argument('--seq-len', type=int, default=300, help='length of each sequence (default 300)')
+    args = parser.parse_args()
+    names, seq_strs = synthetic_seqs(args.num_seqs, args.seq_len)
+    data_bytes = sum(sys.getsizeof(seq) for seq in seq_strs) + sum(sys.getsizeof(name) for name in names)
+    print('{} sequences of length {}; names and residue strings use {:.1f} bytes per sequence'.format(args.num_seqs, args.seq_len, data_bytes / args.num_seqs))
+    results = {}
+    for label, build in (('before (__dict__ + parent_refs)', build_legacy), ('after (__slots__)', build_current)):
+        used, peak = measure(build, names, seq_strs)
+        results[label] = used
+        print('  {:32} {:8.1f} bytes per sequence  (peak {:.1f} MB)'.format(label, used / args.num_seqs, peak / 2**20))
+    before, after = results.values()
+    print('  overhead reduced by {:.1f}x'.format(before / after))
@@ -0,0 +1,53 @@
+"""
+Checks that a SeqList's name index stays consistent when more sequences are renamed than Sequence.rename_journal holds, so the index has to be rebuilt, and sequences are then added or removed. Also checks that the journal doesn't keep renamed Sequences alive.
+Run from the repository root: python dev_files/check_seqlist_index.py [--num-seqs 5000]
+"""
+# Author: Dave Curran
+# Date: Aug 2022
+
+import os, sys, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app_scripts import sequ
+
+
+def build(num_seqs):
+    return sequ.SeqList([sequ.Sequence('seq {}'.format(ind), 'ACGT'[:ind % 5]) for ind in range(num_seqs)])
+def check_consistent(seqs, label):
+    """Raises a RuntimeError if the name index doesn't hold exactly the sequences in `seqs`, each under its current name."""
+    seqs._sync_names()
+    indexed = []
+    for name, hit in seqs.names_index.items():
+        for seq in (hit if type(hit) is list else [hit]):
+            if seq.name != name:
+                raise RuntimeError("{}: '{}' is indexed under '{}'".format(label, seq.name, name))
+            indexed.append(id(seq))
+    if sorted(indexed) != sorted(id(seq) for seq in seqs):
+        raise RuntimeError('{}: the name index and the list hold different sequences'.format(label))
+    if seqs.size != sum(len(seq) for seq in seqs):
+        raise RuntimeError('{}: the size statistic is out of date'.format(label))
+def run_checks(num_seqs):
+    edits = {
+        'remove_shorter': lambda seqs: seqs.remove_shorter(3),
+        'pop': lambda seqs: seqs.pop(),
+        'remove': lambda seqs: seqs.remove(seqs[10]),
+        'clear': lambda seqs: seqs.clear(),
+        'del slice': lambda seqs: seqs.__delitem__(slice(3, 9)),
+        'setitem': lambda seqs: seqs.__setitem__(4, sequ.Sequence('new', 'A')),
+        'insert': lambda seqs: seqs.insert(0, sequ.Sequence('seq_1', 'C')),
+        'append': lambda seqs: seqs.append(sequ.Sequence('seq_2', 'G')),
+    }
+    for label, edit in edits.items():
+        seqs = build(num_seqs)
+        seqs.clean_names() # Renames every sequence, overflowing the journal
+        edit(seqs)
+        check_consistent(seqs, label)
+        print('  {:16} ok'.format(label))
+    if any(isinstance(entry[0], sequ.Sequence) for entry in sequ.Sequence.rename_journal):
+        raise RuntimeError('Sequence.rename_journal holds references to Sequences')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the SeqList name index after many renames.')
+    parser.add_argument('--num-seqs', type=int, default=5000, help='number of sequences to rename; should exceed Sequence.max_journal (default 5000)')
+    args = parser.parse_args()
+    run_checks(args.num_seqs)
@@ -51,7 +51,6 @@ from kivy.graphics.instructions import Callback
 # Reformat the landing page. I want one area (info/button) for an alignment file, a second for a PDB file, a third for secondary structure, fourth for regions, fifth for sequence groups.
 #  - Depending on the files currently loaded, the other screens will become available. Ex only aln loaded, can view, graph quality, but can't map to pdb. If only pdb loaded, can only predict secondary structure. If only pdb + dssp loaded, can View Alignment (where the alignment is just the sequence from the pdb).
 # Give the variation graph a y-axis title, possibly x-axis as well
-# Consider sliding window for calculation of variation. Or perhaps calculation of the mean line. Check a couple real gappy alignments. 
 # Implement ability to select one sequence to display instead of consensus. Searchable + scrollable popup list. The View screen will likely use a version that can incorporate checkboxes. 
 #  - When displaying sequence on Variation, ignore gaps? Option to? 
 
@@ -599,6 +598,8 @@ class AlnKeyMain(ScreenManager):
         self.alignment = None # A SeqList once loaded by MainScreen
         self.alignment_lengths = []
         self.alignment_consensus = ''
+        self.alignment_profile = None # An align.ColumnProfile, shared by the screens
+        self.alignment_cache = sequ.SeqCache(os.path.join(self.app.user_data_dir, 'alignment_cache')) # Speeds up reloading large alignments
     def change_screen(self, new_screen_name):
         print('\n- changing to', new_screen_name, 'sizes:', Window.size, self.get_screen(new_screen_name).screen_size)
         self.current_screen.screen_size = Window.size
@@ -649,9 +650,10 @@ class MainScreen(BaseScreen, LoadFiles, SaveFiles):
         self.manager.alignment = None
         self.manager.alignment_lengths = []
         self.manager.alignment_consensus = ''
+        self.manager.alignment_profile = None
         self.aln_missing = True
         try:
-            aln = sequ.load(filepath)
+            aln = sequ.load(filepath, cache=self.manager.alignment_cache)
         except:
             self.aln_status_text = '[b]Error:[/b] could not load chosen alignment file.\n\n{}'.format(self.default_aln_status_text)
             return False
@@ -662,7 +664,8 @@ class MainScreen(BaseScreen, LoadFiles, SaveFiles):
         self.manager.alignmant_path = filepath
         self.manager.alignment = aln
         self.manager.alignment_lengths = aln.lengths
-        self.manager.alignment_consensus = align.consensus(aln)
+        self.manager.alignment_profile = align.ColumnProfile(aln)
+        self.manager.alignment_consensus = self.manager.alignment_profile.consensus()
         self.aln_missing = False
         return True
     def export_alignment_button(self, format):
@@ -723,6 +726,8 @@ class VariationScreen(BaseScreen, SaveFiles, DrawGraphics):
         #self.show_sequence_cb = Bool
         #self.graph_type_radio = Str
         #self.num_variants_input = LabelledInput
+        #self.smooth_window_input = LabelledInput
+        #self.smooth_type_radio = Str
         #self.colour_by_radio = Str
         #self.first_res_input = LabelledInput
         #self.show_range_input = LabelledInputRange
@@ -766,9 +771,9 @@ class VariationScreen(BaseScreen, SaveFiles, DrawGraphics):
         
     def load_variation_then_draw(self, dt=None):
         print('loading', dt)
-        self.variations = align.variation(self.manager.alignment) # long step
-        self.variants = align.variants(self.manager.alignment) # brief but noticable pause
-        # Can I combine both of the above functions into a single pass through the alignment?
+        profile = self.manager.alignment_profile # Built in a single pass when the alignment was loaded
+        self.variations = align.variation(profile)
+        self.variants = align.variants(profile)
         print('done loading')
         #self.draw_graphics()
         Clock.schedule_once(self.draw_graphics, 0) # Clock calls are performed by the main thread, and only the main thread can draw.
@@ -847,7 +852,12 @@ class VariationScreen(BaseScreen, SaveFiles, DrawGraphics):
             num_variants = int(self.num_variants_input.text)
         else:
             num_variants = 0
-
+        # Smoothing is applied to the raw per-column scores, which are not recomputed
+        smooth_window = int(self.smooth_window_input.text)
+        if smooth_window > 1:
+            column_variations = align.sliding_window(self.variations, smooth_window, self.smooth_type_radio)
+        else:
+            column_variations = self.variations
 
         ignore_gaps = self.filter_gaps_cb # False #True # Should be set by UI element
         # TODO: Allow selection of sequence to display
@@ -876,7 +886,7 @@ class VariationScreen(BaseScreen, SaveFiles, DrawGraphics):
             sequence.append((residue, seq_ind, perc))
             if residue != '-':
                 seq_ind += 1
-            variations.append(self.variations[i])
+            variations.append(column_variations[i])
             if num_variants:
                 vnts_norm = self.variants[i][0][1] # Normalized against most frequent character, not total
                 if sequence_name == 'Consensus':